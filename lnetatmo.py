@@ -17,8 +17,48 @@ if __name__ == "__main__": warnings.filterwarnings("ignore")
 from sys import version_info
 from os import getenv
 from os.path import expanduser
+import os
+from contextlib import contextmanager
 import json, time
+import bisect
+import copy
+import base64
+import hashlib
+import mmap
 import logging
+import random
+import sqlite3
+import threading
+import weakref
+import zlib
+from array import array
+from collections import OrderedDict, deque
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+from datetime import datetime, timedelta
+from itertools import compress
+
+try:
+    import fcntl                                                                          # File locks (POSIX only)
+except ImportError:
+    fcntl = None
+
+try:
+    from types import MappingProxyType                                                    # Read-only views of dictionaries
+except ImportError:
+    MappingProxyType = dict
+
+try:
+    from zoneinfo import ZoneInfo                                                         # Python 3.9+, station timezones
+except ImportError:
+    ZoneInfo = None
+
+try:
+    import numpy                                                                          # Optional, zero copy arrays of measures
+except ImportError:
+    numpy = None
 
 # Just in case method could change
 PYTHON3 = version_info.major > 2
@@ -26,6 +66,7 @@ PYTHON3 = version_info.major > 2
 # HTTP libraries depends upon Python 2 or 3
 if PYTHON3 :
     import urllib.parse, urllib.request
+    import http.client
 else:
     from urllib import urlencode
     import urllib2
@@ -225,67 +266,504 @@ class AuthFailure( Exception ):
 class OutOfScope( Exception ):
     """Your current auth scope do not allow access to this resource"""
 
+class RateLimited( Exception ):
+    """The request would exceed the Netatmo quota and waiting is not allowed"""
+
+class ConnectError( IOError ):
+    """Connection to the server could not be established, the request was not sent"""
+
+class ApiError( Exception ):
+    """A Netatmo request failed (details have been logged)"""
+
+@contextmanager
+def fileLock(path):
+    """Exclusive lock shared by processes using the same lock file (no-op if fcntl is not available)"""
+    if not (fcntl and path):
+        yield
+        return
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def writeAtomic(path, content):
+    """Replace file content atomically : a crash leave either the old or the new content, never a truncated file"""
+    tmp = "%s.%d.tmp" % (path, os.getpid())
+    # Keep the mode of the replaced file, credentials are private by default
+    mode = os.stat(path).st_mode & 0o777 if os.path.exists(path) else 0o600
+    if os.path.exists(tmp): os.unlink(tmp)
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        os.chmod(tmp, mode)
+        with os.fdopen(fd, "wb") as f:
+            fd = None
+            f.write(content.encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    finally:
+        if fd is not None: os.close(fd)
+        if os.path.exists(tmp): os.unlink(tmp)
+
+
+class TokenStore:
+    """
+    JSON file holding credentials and tokens of several accounts, so that a single process
+    can manage many users : { account : {"CLIENT_ID", "CLIENT_SECRET", "REFRESH_TOKEN", "ACCESS_TOKEN", "EXPIRATION"} }
+    The file is updated atomically under a file lock
+
+    Args:
+        path (str): Store file
+    """
+    def __init__(self, path="~/.netatmo.tokens"):
+        self.path = expanduser(path)
+
+    def _read(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.loads(f.read())
+        except IOError:
+            return {}
+
+    def accounts(self):
+        return list(self._read())
+
+    def load(self, account):
+        cred = self._read().get(account)
+        return {k.upper():v for k,v in cred.items()} if cred else None
+
+    def save(self, account, cred):
+        with fileLock(self.path + ".lock"):
+            store = self._read()
+            store[account] = cred
+            writeAtomic(self.path, json.dumps(store, indent=True))
+
+    def lockFile(self, account):
+        # Renewal lock of an account, distinct from the store update lock
+        return "%s.%s.lock" % (self.path, hashlib.sha1(account.encode("utf-8")).hexdigest()[:12])
+
+
 class ClientAuth:
     """
     Request authentication and keep access token available through token method. Renew it automatically if necessary
+    Token renewal is done once for all threads, and for all processes sharing the same credential file.
+    The access token and its expiration are persisted along the refresh token and reused by next process starts
 
     Args:
         clientId (str): Application clientId delivered by Netatmo on dev.netatmo.com
         clientSecret (str): Application Secret key delivered by Netatmo on dev.netatmo.com
         refreshToken (str) : Scoped refresh token
+        credentialFile (str) : Credential file, default ~/.netatmo.credentials
+        tokenStore (TokenStore) : Multi-account store to use instead of a credential file
+        account (str) : Account name in the token store
     """
 
     def __init__(self, clientId=None,
                        clientSecret=None,
                        refreshToken=None,
-                       credentialFile=None):
-
-        # replace values with content of env variables if defined
-        clientId = getenv("CLIENT_ID", clientId)
-        clientSecret = getenv("CLIENT_SECRET", clientSecret)
-        refreshToken = getenv("REFRESH_TOKEN", refreshToken)
-
-        # Look for credentials in file if not already provided
-        # Note: this file will be rewritten by the library to record refresh_token change
-        # If you run your application in container, remember to persist this file
-        if not (clientId and clientSecret and refreshToken):
-            self._credentialFile = credentialFile or expanduser("~/.netatmo.credentials")
-            with open(self._credentialFile, "r", encoding="utf-8") as f:
-                cred = {k.upper():v for k,v in json.loads(f.read()).items()}
-        else:
-            # Calling program will need to handle the returned refresh_token for futur call
-            # by getting refreshToken property of the ClientAuth instance and persist it somewhere
+                       credentialFile=None,
+                       tokenStore=None,
+                       account="default"):
+
+        self._tokenStore = tokenStore
+        self._account = account
+        if tokenStore:
+            # Stored values are more recent than initial parameters once the account has been used
             self._credentialFile = None
+            cred = tokenStore.load(account) or {}
+            clientId = cred.get("CLIENT_ID", clientId)
+            clientSecret = cred.get("CLIENT_SECRET", clientSecret)
+            refreshToken = cred.get("REFRESH_TOKEN", refreshToken)
+        else:
+            # replace values with content of env variables if defined
+            clientId = getenv("CLIENT_ID", clientId)
+            clientSecret = getenv("CLIENT_SECRET", clientSecret)
+            refreshToken = getenv("REFRESH_TOKEN", refreshToken)
+
+            # Look for credentials in file if not already provided
+            # Note: this file will be rewritten by the library to record refresh_token change
+            # If you run your application in container, remember to persist this file
+            if not (clientId and clientSecret and refreshToken):
+                self._credentialFile = credentialFile or expanduser("~/.netatmo.credentials")
+                with open(self._credentialFile, "r", encoding="utf-8") as f:
+                    cred = {k.upper():v for k,v in json.loads(f.read()).items()}
+            else:
+                # Calling program will need to handle the returned refresh_token for futur call
+                # by getting refreshToken property of the ClientAuth instance and persist it somewhere
+                self._credentialFile = None
+                cred = {}
 
         self._clientId = clientId or cred["CLIENT_ID"]
         self._clientSecret = clientSecret or cred["CLIENT_SECRET"]
         self._accessToken = None # Will be refreshed before any use
         self.refreshToken = refreshToken or cred["REFRESH_TOKEN"]
         self.expiration = 0 # Force refresh token
+        self._lock = threading.RLock()
+        self._refresher = None
+        # Reuse the access token of a previous run if still valid
+        if cred.get("REFRESH_TOKEN") == self.refreshToken: self._adoptToken(cred)
 
     @property
     def accessToken(self):
-        if self.expiration < time.time() : self.renew_token()
+        if self.expiration < time.time():
+            with self._lock:
+                # Another thread may have renewed the token while we were waiting
+                if self.expiration < time.time() : self.renew_token()
         return self._accessToken
 
+    def _renewLockFile(self):
+        # Lock file shared by all processes renewing the tokens of this account
+        if self._tokenStore:
+            return self._tokenStore.lockFile(self._account)
+        return self._credentialFile + ".lock" if self._credentialFile else None
+
     def renew_token(self):
-        postParams = {
+        with self._lock, fileLock(self._renewLockFile()):
+            # Another process may have renewed the tokens, never use a stale refresh token
+            expiration = self.expiration
+            self._reloadStored()
+            if self.expiration > expiration: return
+            resp = postRequest("authentication", _AUTH_REQ, self._renewParams())
+            if not resp and self._reloadStored():
+                # Rotated in between by a process not sharing the lock
+                resp = postRequest("authentication", _AUTH_REQ, self._renewParams())
+            if not resp: raise AuthFailure("Token renewal rejected by Netatmo")
+            self._tokenReceived(resp)
+
+    def startRefresher(self, margin=300):
+        """
+        Renew the access token in a background thread margin seconds before it expires
+        so that requests never wait for a token renewal
+        """
+        if self._refresher: return
+        self._stopRefresher = threading.Event()
+        self._refresher = threading.Thread(target=self._refreshLoop, args=(margin,), name="lnetatmo-token-refresher")
+        self._refresher.daemon = True
+        self._refresher.start()
+
+    def stopRefresher(self):
+        if not self._refresher: return
+        self._stopRefresher.set()
+        self._refresher.join()
+        self._refresher = None
+
+    def _refreshLoop(self, margin):
+        while not self._stopRefresher.is_set():
+            wait = self.expiration - margin - time.time()
+            if wait <= 0:
+                try:
+                    with self._lock:
+                        if self.expiration - margin <= time.time(): self.renew_token()
+                    continue
+                except Exception as e:
+                    logger.error("Background token renewal failed : %s" % e)
+                    wait = 60
+            self._stopRefresher.wait(wait)
+
+    def _loadStored(self):
+        if self._tokenStore: return self._tokenStore.load(self._account)
+        if not self._credentialFile: return None
+        try:
+            with open(self._credentialFile, "r", encoding="utf-8") as f:
+                return {k.upper():v for k,v in json.loads(f.read()).items()}
+        except (IOError, ValueError):
+            return None
+
+    def _adoptToken(self, cred):
+        # Use a persisted access token if more recent than ours and valid for at least one more minute
+        expiration = cred.get("EXPIRATION", 0)
+        if cred.get("ACCESS_TOKEN") and expiration > max(self.expiration, time.time() + 60):
+            self._accessToken = cred["ACCESS_TOKEN"]
+            self.expiration = expiration
+            registerToken(self._accessToken, self._clientId)
+
+    def _reloadStored(self):
+        # Take tokens renewed by another process, return True if the refresh token changed
+        cred = self._loadStored()
+        if not cred or "REFRESH_TOKEN" not in cred: return False
+        changed = cred["REFRESH_TOKEN"] != self.refreshToken
+        self.refreshToken = cred["REFRESH_TOKEN"]
+        self._adoptToken(cred)
+        return changed
+
+    def _renewParams(self):
+        return {
                 "grant_type" : "refresh_token",
                 "refresh_token" : self.refreshToken,
                 "client_id" : self._clientId,
                 "client_secret" : self._clientSecret
                 }
-        resp = postRequest("authentication", _AUTH_REQ, postParams)
-        if self.refreshToken != resp['refresh_token']:
-            self.refreshToken = resp['refresh_token']
-            cred = {"CLIENT_ID":self._clientId,
-                    "CLIENT_SECRET":self._clientSecret,
-                    "REFRESH_TOKEN":self.refreshToken }
-            if self._credentialFile:
-                with open(self._credentialFile, "w", encoding="utf-8") as f:
-                    f.write(json.dumps(cred, indent=True))
+
+    def _tokenReceived(self, resp):
+        self.refreshToken = resp['refresh_token']
         self._accessToken = resp['access_token']
         self.expiration = int(resp['expire_in'] + time.time())
+        registerToken(self._accessToken, self._clientId)
+        cred = {"CLIENT_ID":self._clientId,
+                "CLIENT_SECRET":self._clientSecret,
+                "REFRESH_TOKEN":self.refreshToken,
+                "ACCESS_TOKEN":self._accessToken,
+                "EXPIRATION":self.expiration }
+        if self._tokenStore:
+            self._tokenStore.save(self._account, cred)
+        elif self._credentialFile:
+            writeAtomic(self._credentialFile, json.dumps(cred, indent=True))
+
+
+class DeviceIndex:
+    """
+    Index of the devices loaded by WeatherStationData, HomeData, ThermostatData and HomeCoach
+    (shared as lnetatmo.deviceIndex) : constant time lookups by id or name, and queries by type,
+    category (TYPES, eg. "Energy") or home. Each object has its own entries, replaced when it loads
+    again and dropped when it is garbage collected. Global queries return the latest loaded devices
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._devices = {}                                                                # id : (device, meta)
+        self._sources = {}                                                                # source : ({ id : (device, meta) }, { name : [devices] })
+        self._byKey = {"name" : {}, "type" : {}, "category" : {}, "home" : {}}            # key : { value : { id : device } }
+
+    @staticmethod
+    def _keys(meta):
+        return (("name", meta["name"]), ("type", meta["type"]), ("category", meta["category"]),
+                ("home", meta["home_id"]), ("home", meta["home_name"]))
+
+    def _publish(self, did, device, meta):
+        # Called with lock held, make a device the global one for its id
+        self._devices[did] = (device, meta)
+        for key, value in self._keys(meta):
+            if value is not None: self._byKey[key].setdefault(value, {})[did] = device
+
+    def update(self, source, entries):
+        """
+        Replace the devices of a source
+
+        Args:
+            source : key of the loading object
+            entries : iterable of (device, name, home_id, home_name)
+        """
+        with self._lock:
+            self._remove(source)
+            ids, names = {}, {}
+            for device, name, home_id, home_name in entries:
+                did = device.get('_id') or device.get('id')
+                mtype = device.get('type')
+                meta = {"id" : did, "name" : name, "type" : mtype, "category" : TYPES.get(mtype, [None, None])[1],
+                        "home_id" : home_id, "home_name" : home_name, "source" : source}
+                ids[did] = (device, meta)
+                names.setdefault(name, []).append(device)
+                self._publish(did, device, meta)
+            self._sources[source] = (ids, names)
+
+    def remove(self, source):
+        """Drop the devices of a source"""
+        with self._lock:
+            self._remove(source)
+
+    def _remove(self, source):
+        ids, _ = self._sources.pop(source, ({}, {}))
+        for did in ids:
+            device, meta = self._devices.get(did, (None, {}))
+            # Global entry belongs to another source
+            if meta.get("source") != source: continue
+            del self._devices[did]
+            for key, value in self._keys(meta):
+                self._byKey[key].get(value, {}).pop(did, None)
+            # Fall back on another source knowing the device
+            for other, _ in self._sources.values():
+                if did in other:
+                    self._publish(did, *other[did])
+                    break
+
+    def get(self, key, source=None):
+        """Device of an id, else the first device with that name (restricted to a source if given)"""
+        with self._lock:
+            if source is not None:
+                ids, names = self._sources.get(source, ({}, {}))
+                if key in ids: return ids[key][0]
+                return names[key][0] if key in names else None
+            if key in self._devices: return self._devices[key][0]
+            named = self._byKey["name"].get(key)
+            return next(iter(named.values())) if named else None
+
+    def meta(self, did, source=None):
+        """{ id, name, type, category, home_id, home_name, source } of a device id"""
+        with self._lock:
+            entries = self._sources.get(source, ({}, {}))[0] if source is not None else self._devices
+            return entries[did][1] if did in entries else None
+
+    def byName(self, name, source=None):
+        with self._lock:
+            if source is not None:
+                return list(self._sources.get(source, ({}, {}))[1].get(name, []))
+            return list(self._byKey["name"].get(name, {}).values())
+
+    def byType(self, mtype):
+        with self._lock:
+            return list(self._byKey["type"].get(mtype, {}).values())
+
+    def byCategory(self, category):
+        with self._lock:
+            return list(self._byKey["category"].get(category, {}).values())
+
+    def byHome(self, home):
+        """Devices of a home id or name"""
+        with self._lock:
+            return list(self._byKey["home"].get(home, {}).values())
+
+    def __len__(self):
+        with self._lock:
+            return len(self._devices)
+
+# Devices of all loaded objects
+deviceIndex = DeviceIndex()
+
+def _indexSource(obj):
+    # Index key of an object : its class, account and identity, entries are dropped with the object
+    source = getattr(obj, "_source", None)
+    if source is None:
+        source = "%s|%s|%x" % (obj.__class__.__name__, rateKey(obj.getAuthToken), id(obj))
+        if hasattr(weakref, "finalize"): weakref.finalize(obj, deviceIndex.remove, source)
+    return source
+
+
+class Values(Mapping):
+    """
+    Read-only compact mapping (eg. dashboard data) : values in a tuple, the key index being shared
+    by all mappings with the same keys
+    """
+    __slots__ = ("_index", "_values")
+    _indexes = {}                                                                         # keys tuple : { key : position }
+
+    def __init__(self, data):
+        keys = tuple(data)
+        index = Values._indexes.get(keys)
+        if index is None: index = Values._indexes.setdefault(keys, {k : i for i, k in enumerate(keys)})
+        self._index = index
+        self._values = tuple(data[k] for k in keys)
+
+    def __getitem__(self, key):
+        return self._values[self._index[key]]
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return "Values(%s)" % dict(self)
+
+
+class _Model(object):
+    """
+    Compact device object built from a raw API dictionary : fields are slots, rarely used sub-objects
+    are kept as compact json text until first access, the raw dictionary is only kept on request
+    """
+    __slots__ = ("_raw",)
+    _FIELDS = {}                                                                          # attribute : raw key
+    _LAZY = {}                                                                            # attribute : raw key
+    _VALUES = ()                                                                          # attributes kept as Values
+
+    def __init__(self, raw, keepRaw=False):
+        for attr, key in self._FIELDS.items():
+            setattr(self, attr, raw.get(key))
+        for attr in self._VALUES:
+            v = getattr(self, attr)
+            if v is not None: setattr(self, attr, Values(v))
+        for attr, key in self._LAZY.items():
+            v = raw.get(key)
+            setattr(self, "_" + attr, None if v is None else json.dumps(v, separators=(",", ":")))
+        self._raw = raw if keepRaw else None
+
+    def _lazy(self, attr):
+        v = getattr(self, "_" + attr)
+        if isinstance(v, str):
+            v = json.loads(v)
+            setattr(self, "_" + attr, v)
+        return v
+
+    @property
+    def raw(self):
+        """Raw API dictionary if kept (keepRaw=True), else None"""
+        return self._raw
+
+    def __repr__(self):
+        return "%s(%s, %s)" % (self.__class__.__name__, self.id, getattr(self, "name", None) or getattr(self, "type", None))
+
+
+class Module(_Model):
+    """Weather module or thermostat, event_history and therm_program_list are parsed on first access"""
+    __slots__ = ("id", "name", "type", "firmware", "battery_vp", "battery_percent", "rf_status", "reachable",
+                 "last_seen", "last_message", "date_setup", "data_type", "dashboard", "station_id",
+                 "_event_history", "_therm_program_list")
+    _FIELDS = {"id" : "_id", "name" : "module_name", "type" : "type", "firmware" : "firmware", "battery_vp" : "battery_vp",
+               "battery_percent" : "battery_percent", "rf_status" : "rf_status", "reachable" : "reachable",
+               "last_seen" : "last_seen", "last_message" : "last_message", "date_setup" : "date_setup",
+               "data_type" : "data_type", "dashboard" : "dashboard_data"}
+    _LAZY = {"event_history" : "event_history", "therm_program_list" : "therm_program_list"}
+    _VALUES = ("dashboard",)
+
+    def __init__(self, raw, station_id=None, keepRaw=False):
+        _Model.__init__(self, raw, keepRaw)
+        if self.name is None: self.name = self.id
+        self.station_id = station_id
+
+    event_history = property(lambda self: self._lazy("event_history"))
+    therm_program_list = property(lambda self: self._lazy("therm_program_list"))
+
+
+class Station(_Model):
+    """Weather station (or thermostat relay) with its modules, place is parsed on first access"""
+    __slots__ = ("id", "name", "module_name", "type", "home_id", "home_name", "firmware", "wifi_status", "reachable",
+                 "last_status_store", "date_setup", "data_type", "dashboard", "modules", "_place")
+    _FIELDS = {"id" : "_id", "name" : "station_name", "module_name" : "module_name", "type" : "type",
+               "home_id" : "home_id", "home_name" : "home_name", "firmware" : "firmware", "wifi_status" : "wifi_status",
+               "reachable" : "reachable", "last_status_store" : "last_status_store", "date_setup" : "date_setup",
+               "data_type" : "data_type", "dashboard" : "dashboard_data"}
+    _LAZY = {"place" : "place"}
+    _VALUES = ("dashboard",)
+
+    def __init__(self, raw, keepRaw=False):
+        _Model.__init__(self, raw, keepRaw)
+        self.modules = [Module(m, self.id, keepRaw) for m in raw.get('modules', [])]
+
+    place = property(lambda self: self._lazy("place"))
+
+
+class Camera(_Model):
+    __slots__ = ("id", "name", "type", "status", "sd_status", "alim_status", "vpn_url", "is_local",
+                 "light_mode_status", "home_id", "home_name")
+    _FIELDS = {"id" : "id", "name" : "name", "type" : "type", "status" : "status", "sd_status" : "sd_status",
+               "alim_status" : "alim_status", "vpn_url" : "vpn_url", "is_local" : "is_local",
+               "light_mode_status" : "light_mode_status", "home_id" : "home_id"}
+
+    def __init__(self, raw, home_name=None, keepRaw=False):
+        _Model.__init__(self, raw, keepRaw)
+        self.home_name = home_name
+
+
+class Person(_Model):
+    """Known or unknown person, face is parsed on first access"""
+    __slots__ = ("id", "name", "last_seen", "out_of_sight", "_face")
+    _FIELDS = {"id" : "id", "name" : "pseudo", "last_seen" : "last_seen", "out_of_sight" : "out_of_sight"}
+    _LAZY = {"face" : "face"}
+
+    face = property(lambda self: self._lazy("face"))
+
+
+class Event(_Model):
+    """Camera event, snapshot is parsed on first access"""
+    __slots__ = ("id", "type", "time", "camera_id", "device_id", "person_id", "message", "video_id",
+                 "video_status", "is_arrival", "_snapshot")
+    _FIELDS = {"id" : "id", "type" : "type", "time" : "time", "camera_id" : "camera_id", "device_id" : "device_id",
+               "person_id" : "person_id", "message" : "message", "video_id" : "video_id",
+               "video_status" : "video_status", "is_arrival" : "is_arrival"}
+    _LAZY = {"snapshot" : "snapshot"}
+
+    snapshot = property(lambda self: self._lazy("snapshot"))
 
 
 class User:
@@ -330,6 +808,9 @@ class HomeStatus:
                 "home_id": home_id
                 }
         resp = postRequest("home_status", _HOME_STATUS, postParams)
+        self._load(resp, home_id)
+
+    def _load(self, resp, home_id):
         self.resp = resp
         self.rawData = resp['body']['home']
         if not self.rawData : raise NoHome("No home %s found" % home_id)
@@ -390,6 +871,13 @@ class ThermostatData:
         resp = postRequest("Thermostat", _GETTHERMOSTATDATA_REQ, postParams)
         self.rawData = resp['body']['devices']
         if not self.rawData : raise NoDevice("No thermostat available")
+        self._source = _indexSource(self)
+        entries = []
+        for Relay in self.rawData:
+            entries.append((Relay, Relay.get('station_name'), Relay.get('home_id'), Relay.get('home_name')))
+            for module in Relay.get('modules', []):
+                entries.append((module, module.get('module_name'), Relay.get('home_id'), Relay.get('home_name')))
+        deviceIndex.update(self._source, entries)
         #
         # keeping OLD code for Reference
 #        self.thermostatData = filter_home_data(self.rawData, home)
@@ -426,23 +914,10 @@ class ThermostatData:
 
 
     def getThermostat(self, name=None, id=""):
-        for Relay in self.rawData:
-            for module in Relay['modules']:
-                if id == Relay['_id']:
-                        print ('Relay ', id, 'found')
-                        return Relay
-                elif name == Relay['station_name']:
-                        print ('Relay ', name, 'found')
-                        return Relay
-                elif id == module['_id']:
-                        print ('Thermostat ', id, 'found in Relay', Relay['_id'], Relay['station_name'])
-                        return module
-                elif name == module['module_name']:
-                        print ('Thermostat ', name, 'found in Relay', Relay['_id'], Relay['station_name'])
-                        return module
-                else:
-                    #print ('Device NOT Found')
-                    pass
+        device = deviceIndex.get(id, self._source) or (deviceIndex.get(name, self._source) if name else None)
+        if device:
+            print ('Device ', id or name, 'found')
+        return device
 
     def moduleNamesList(self, name=None, tid=None):
         l = []
@@ -460,15 +935,9 @@ class ThermostatData:
         return l
 
     def getModuleByName(self, name, tid=""):
-        for Relay in self.rawData:
-            for module in Relay['modules']:
-                #print (module['module_name'], module['_id'])
-                if module['module_name'] == name:
-                    return module
-                elif module['_id'] == tid:
-                    return module
-                else:
-                    pass
+        module = deviceIndex.get(name, self._source) or deviceIndex.get(tid, self._source)
+        # Relays are not modules
+        return module if module and module.get('type') != 'NAPlug' else None
 
 
 class WeatherStationData:
@@ -478,15 +947,38 @@ class WeatherStationData:
     Args:
         authData (ClientAuth): Authentication information with a working access Token
     """
-    def __init__(self, authData, home=None, station=None):
+    def __init__(self, authData, home=None, station=None, measureCache=None):
+        self._authData = authData
+        self.measureCache = measureCache
         self.getAuthToken = authData.accessToken
         postParams = {
                 "access_token" : self.getAuthToken
                 }
         resp = postRequest("Weather station", _GETSTATIONDATA_REQ, postParams)
+        self._load(resp, home, station)
+
+    def _token(self):
+        # Long running uses (paging, backfill) may outlive the token got at creation
+        authData = getattr(self, "_authData", None)
+        return authData.accessToken if authData else self.getAuthToken
+
+    def _load(self, resp, home, station):
         self.rawData = resp['body']['devices']
         # Weather data
         if not self.rawData : raise NoDevice("No weather station in any homes")
+        self._buildMaps(home, station)
+        # User data
+        userData = resp['body']['user']
+        self.user = UserInfo()
+        setattr(self.user, "mail", userData['mail'])
+        for k,v in userData['administrative'].items():
+            if k in UNITS:
+                setattr(self.user, k, UNITS[k][v])
+            else:
+                setattr(self.user, k, v)
+
+    def _buildMaps(self, home, station):
+        self._snapshots = {}
         # Stations are no longer in the Netatmo API, keeping them for compatibility
         self.stations = { d['station_name'] : d for d in self.rawData }
         self.stationIds = { d['_id'] : d for d in self.rawData }
@@ -510,15 +1002,69 @@ class WeatherStationData:
         if 'modules' in self.default_station_data:
             for m in self.default_station_data['modules']:
                 self.modules[ m['_id'] ] = m
-        # User data
-        userData = resp['body']['user']
-        self.user = UserInfo()
-        setattr(self.user, "mail", userData['mail'])
-        for k,v in userData['administrative'].items():
-            if k in UNITS:
-                setattr(self.user, k, UNITS[k][v])
-            else:
-                setattr(self.user, k, v)
+        self._source = _indexSource(self)
+        entries = []
+        for d in self.rawData:
+            entries.append((d, d.get('module_name'), d.get('home_id'), d.get('home_name')))
+            for m in d.get('modules', []):
+                entries.append((m, m.get('module_name', m['_id']), d.get('home_id'), d.get('home_name')))
+        deviceIndex.update(self._source, entries)
+
+    def refresh(self):
+        """
+        Fetch the stations again and update the existing station and module dictionaries in place
+        (user data is kept). Return the change set :
+            { "updated" : [ { "id", "name", "station_id", "time_utc" : (old, new), "values" : { sensor : (old, new) } } ],
+              "lost" : [...], "back" : [...], "added" : [...], "removed" : [...] } (entries with "id", "name", "station_id")
+        A module is lost when it no longer has dashboard data or is no longer reachable, back when it has again
+        """
+        postParams = {
+                "access_token" : self._token()
+                }
+        resp = postRequest("Weather station", _GETSTATIONDATA_REQ, postParams)
+        if not resp: raise ApiError("getstationsdata failed")
+        devices = resp['body']['devices']
+        if not devices : raise NoDevice("No weather station in any homes")
+        old, stationOf = {}, {}
+        for d in self.rawData:
+            old[d['_id']] = d
+            for m in d.get('modules', []): old[m['_id']] = m
+            stationOf.update((m['_id'], d['_id']) for m in [d] + d.get('modules', []))
+        changes = {"updated" : [], "lost" : [], "back" : [], "added" : [], "removed" : []}
+        stations = []
+        for d in devices:
+            if 'modules' in d:
+                d['modules'] = [self._refreshDevice(old.pop(m['_id'], None), m, d['_id'], changes) for m in d['modules']]
+            stations.append(self._refreshDevice(old.pop(d['_id'], None), d, d['_id'], changes))
+        for did, d in old.items():
+            changes["removed"].append({"id" : did, "name" : d.get('module_name', did), "station_id" : stationOf[did]})
+        defaultId = self.default_station_data['_id']
+        self.rawData[:] = stations
+        station = defaultId if any(d['_id'] == defaultId for d in stations) else None
+        self._buildMaps(self.default_home if self.default_home in {d['home_name'] for d in stations} else None, station)
+        return changes
+
+    @staticmethod
+    def _refreshDevice(prev, new, station_id, changes):
+        # Record the changes of a station or module, update the previous dictionary in place
+        entry = {"id" : new['_id'], "name" : new.get('module_name', new['_id']), "station_id" : station_id}
+        if prev is None:
+            changes["added"].append(entry)
+            return new
+        ods, nds = prev.get('dashboard_data'), new.get('dashboard_data')
+        wasAlive = bool(ods) and prev.get('reachable', True) is not False
+        alive = bool(nds) and new.get('reachable', True) is not False
+        if wasAlive and not alive:
+            changes["lost"].append(entry)
+        elif alive and not wasAlive:
+            changes["back"].append(entry)
+        if ods and nds and nds.get('time_utc', 0) > ods.get('time_utc', 0):
+            entry["time_utc"] = (ods.get('time_utc'), nds['time_utc'])
+            entry["values"] = {k : (ods.get(k), nds.get(k)) for k in set(ods) | set(nds) if k != 'time_utc'}
+            changes["updated"].append(entry)
+        prev.clear()
+        prev.update(new)
+        return prev
 
     def modulesNamesList(self, station=None):
         s = self.getStation(station)
@@ -545,10 +1091,18 @@ class WeatherStationData:
 
     def getModule(self, module):
         if module in self.modules: return self.modules[module]
-        for m in self.modules.values():
-            if m['module_name'] == module : return m
+        # Same name may be used in other stations
+        for m in deviceIndex.byName(module, self._source):
+            if m['_id'] in self.modules : return m
         return None
 
+    def model(self, keepRaw=False):
+        """
+        List of Station objects (with their Module objects) of all stations, much more compact than rawData
+        for long running processes that do not need to keep this object
+        """
+        return [Station(d, keepRaw) for d in self.rawData]
+
     # Functions for compatibility with previous versions
     def stationByName(self, station=None):
         return self.getStation(station)
@@ -586,42 +1140,95 @@ class WeatherStationData:
                         if i in module : lastD[module['module_name']][i] = module[i]
         return lastD
 
+    def snapshot(self, station=None):
+        """Snapshot of the last measure times of a station (default station), taken once per load or refresh"""
+        s = self.stationByName(station) or self.stationById(station)
+        if not s : raise NoDevice("No station with name or id %s" % station)
+        if s['_id'] not in self._snapshots: self._snapshots[s['_id']] = Snapshot(s)
+        return self._snapshots[s['_id']]
+
     def checkNotUpdated(self, delay=3600):
-        res = self.lastData()
-        ret = []
-        for mn,v in res.items():
-            if time.time()-v['When'] > delay : ret.append(mn)
+        ret = self.snapshot().notUpdated(delay)
         return ret if ret else None
 
     def checkUpdated(self, delay=3600):
-        res = self.lastData()
-        ret = []
-        for mn,v in res.items():
-            if time.time()-v['When'] < delay : ret.append(mn)
+        ret = self.snapshot().updated(delay)
         return ret if ret else None
 
     def getMeasure(self, device_id, scale, mtype, module_id=None, date_begin=None, date_end=None, limit=None, optimize=False, real_time=False):
-        postParams = { "access_token" : self.getAuthToken }
-        postParams['device_id']  = device_id
-        if module_id : postParams['module_id'] = module_id
-        postParams['scale']      = scale
-        postParams['type']       = mtype
-        if date_begin : postParams['date_begin'] = date_begin
-        if date_end : postParams['date_end'] = date_end
-        if limit : postParams['limit'] = limit
-        postParams['optimize'] = "true" if optimize else "false"
-        postParams['real_time'] = "true" if real_time else "false"
+        cache = getattr(self, "measureCache", None)
+        if cache and date_begin and not (limit or optimize or real_time):
+            return cache.getMeasure(self, device_id, scale, mtype, module_id, date_begin, date_end)
+        postParams = measureParams(self._token(), device_id, scale, mtype, module_id, date_begin, date_end, limit, optimize, real_time)
         return postRequest("Weather station", _GETMEASURE_REQ, postParams)
 
-    def MinMaxTH(self, module=None, frame="last24"):
-        s = self.default_station_data
+    def getMeasureSeries(self, device_id, scale, mtype, module_id=None, date_begin=None, date_end=None, limit=None, optimize=False, real_time=False):
+        """Same request as getMeasure, the body being decoded directly into a MeasureSeries (None on failure)"""
+        postParams = measureParams(self._token(), device_id, scale, mtype, module_id, date_begin, date_end, limit, optimize, real_time)
+        resp = postRequest("Weather station", _GETMEASURE_REQ, postParams, hook=measureSeriesHook(mtype))
+        if not resp: return None
+        body = resp.get('body')
+        return body if isinstance(body, MeasureSeries) else MeasureSeries.fromRows(body, mtype)
+
+    def measureSeries(self, device_id, module_id, mtype, date_begin, date_end=None, scale="max", optimize=True):
+        """MeasureSeries of any date range, getmeasure pages being decoded and appended one after the other"""
+        if not isinstance(mtype, str): mtype = ",".join(mtype)
+        series = MeasureSeries(mtype)
+        begin = int(date_begin)
+        end = int(date_end or time.time())
+        while begin <= end:
+            page = self.getMeasureSeries(device_id, scale, mtype, module_id, begin, end, 1024, optimize)
+            if page is None: raise ApiError("getmeasure failed for %s %s at %s" % (device_id, module_id, begin))
+            series.extend(page)
+            if len(page) < 1024: break
+            begin = page.timestamps[-1] + 1
+        return series
+
+    def rollup(self, device_id, module_id, mtype, date_begin, date_end=None, scales=("30min", "1hour", "3hours", "1day", "1week")):
+        """Rollup of the "max" scale measures of the range, buckets aligned on the station timezone"""
+        s = self.stationById(device_id) or {}
+        r = Rollup(mtype, scales, s.get('place', {}).get('timezone'))
+        r.extend(self.iterMeasure(device_id, module_id, mtype, date_begin, date_end))
+        return r
+
+    def iterMeasure(self, device_id, module_id, mtype, date_begin, date_end=None, scale="max", optimize=True, real_time=False):
+        """
+        Generator of (timestamp, [values]) rows for any date range : getmeasure pages (1024 values max)
+        are requested one after the other as rows are consumed, only one page is in memory at a time.
+        Pages are requested in the (smaller) optimized format by default, rows are the same
+
+        Args:
+            device_id : station id
+            module_id : module id, None for the station own sensors
+            mtype : measure types, comma separated string or list (eg. "Temperature,Humidity")
+            date_begin, date_end : range bounds (epoch), date_end default to now
+        """
+        if not isinstance(mtype, str): mtype = ",".join(mtype)
+        begin = int(date_begin)
+        end = int(date_end or time.time())
+        while begin <= end:
+            resp = self.getMeasure(device_id, scale, mtype, module_id, begin, end, 1024, optimize, real_time)
+            if not resp: raise ApiError("getmeasure failed for %s %s at %s" % (device_id, module_id, begin))
+            last, count = None, 0
+            for ts, values in measureRows(resp['body']):
+                last, count = ts, count + 1
+                yield ts, values
+            # Empty or partial page : no more data in the range
+            if count < 1024: return
+            begin = last + 1
+
+    def MinMaxTH(self, module=None, frame="last24", station=None):
+        s = self.getStation(station)
+        if not s : raise NoDevice("No station with name or id %s" % station)
         if frame == "last24":
             end = time.time()
             start = end - 24*3600 # 24 hours ago
         elif frame == "day":
             start, end = todayStamps()
+        # Optimized format unless served by the measure cache
+        optimize = getattr(self, "measureCache", None) is None
         if module and module != s['module_name']:
-            m = self.moduleById(module) or self.moduleByName(module)
+            m = _stationModule(s, module) if station else self.moduleById(module) or self.moduleByName(module)
             if not m : raise NoDevice("Can't find module %s" % module)
             # retrieve module's data
             resp = self.getMeasure(
@@ -630,20 +1237,55 @@ class WeatherStationData:
                     scale      = "max",
                     mtype      = "Temperature,Humidity",
                     date_begin = start,
-                    date_end   = end)
+                    date_end   = end,
+                    optimize   = optimize)
         else : # retrieve station's data
             resp = self.getMeasure(
                     device_id  = s['_id'],
                     scale      = "max",
                     mtype      = "Temperature,Humidity",
                     date_begin = start,
-                    date_end   = end)
+                    date_end   = end,
+                    optimize   = optimize)
         if resp and resp['body']:
-            T = [v[0] for v in resp['body'].values()]
-            H = [v[1] for v in resp['body'].values()]
-            return min(T), max(T), min(H), max(H)
+            stats = measureStats(resp['body'], ["Temperature", "Humidity"], percentiles=())
+            T, H = stats["Temperature"], stats["Humidity"]
+            if T["count"] and H["count"]:
+                return T["min"], T["max"], H["min"], H["max"]
         return None
 
+    def measureStats(self, modules=None, mtypes=None, date_begin=None, date_end=None, scale="max", percentiles=(5, 25, 50, 75, 95)):
+        """
+        Statistics of measures of several modules of the default station over any range (paged getmeasure requests)
+
+        Args:
+            modules : list of module names or ids, the station name for its own sensors (default : station and all modules)
+            mtypes : list of measure types (default : all types of each module), types not provided by a module are ignored
+            date_begin, date_end : range bounds (epoch), default to the last 24 hours
+
+        Returns:
+            { module_name : { type : stats } }, see measureStats function
+        """
+        s = self.default_station_data
+        date_end = date_end or time.time()
+        date_begin = date_begin or date_end - 24*3600
+        if modules is None:
+            devices = [s] + s.get('modules', [])
+        else:
+            devices = []
+            for name in modules:
+                m = s if name in (s['module_name'], s['_id']) else self.moduleById(name) or self.moduleByName(name)
+                if not m : raise NoDevice("Can't find module %s" % name)
+                devices.append(m)
+        result = {}
+        for m in devices:
+            types = [t for t in measureTypes(m) if mtypes is None or t in mtypes]
+            if not types: continue
+            module_id = None if m is s else m['_id']
+            rows = self.iterMeasure(s['_id'], module_id, types, date_begin, date_end, scale)
+            result[m['module_name']] = measureStats(rows, types, percentiles)
+        return result
+
 
 class DeviceList(WeatherStationData):
     """
@@ -653,6 +1295,907 @@ class DeviceList(WeatherStationData):
             DeprecationWarning )
 
 
+# getmeasure types of module data_type values when they differ
+_MEASURE_TYPES = {
+    "Wind" : ["WindStrength", "WindAngle", "GustStrength", "GustAngle"],
+    }
+
+# Approximate time between two values of each getmeasure scale
+_SCALE_STEP = {
+    "max"    : 300,
+    "30min"  : 1800,
+    "1hour"  : 3600,
+    "3hours" : 3*3600,
+    "1day"   : 24*3600,
+    "1week"  : 7*24*3600,
+    "1month" : 31*24*3600,
+    }
+
+def measureTypes(module):
+    """Return the getmeasure types available for a station or module"""
+    types = []
+    for t in module.get('data_type', []):
+        types.extend(_MEASURE_TYPES.get(t, [t]))
+    return types
+
+
+_NAN = float("nan")
+
+def _isBlocks(rows):
+    # Optimized getmeasure body, not a list of (timestamp, [values]) rows
+    return isinstance(rows, list) and bool(rows) and isinstance(rows[0], dict) and 'beg_time' in rows[0]
+
+def _blockColumns(blocks, ntypes):
+    # Expand optimized getmeasure blocks column by column, timestamps from the block steps
+    ts = array("q")
+    columns = [array("d") for _ in range(ntypes)]
+    for block in sorted(blocks, key=lambda b: b['beg_time']):
+        beg, step, values = block['beg_time'], block.get('step_time', 0), block['value']
+        ts.extend(range(beg, beg + len(values) * step, step) if step else [beg] * len(values))
+        for i, c in enumerate(columns):
+            c.extend(_NAN if i >= len(v) or v[i] is None else v[i] for v in values)
+    return ts, columns
+
+def measureColumns(rows, ntypes):
+    """
+    Decode getmeasure rows (or a response body) into columns : array('q') of timestamps and
+    one array('d') of values per type, NaN for missing values
+    """
+    if isinstance(rows, MeasureSeries): return rows.timestamps, rows.columns
+    if _isBlocks(rows): return _blockColumns(rows, ntypes)
+    if isinstance(rows, dict): rows = measureRows(rows)
+    ts = array("q")
+    columns = [array("d") for _ in range(ntypes)]
+    for t, values in rows:
+        ts.append(t)
+        for i in range(ntypes):
+            v = values[i] if i < len(values) else None
+            columns[i].append(_NAN if v is None else v)
+    return ts, columns
+
+def _percentile(ordered, p):
+    # Linear interpolation between closest ranks (numpy default)
+    k = (len(ordered) - 1) * p / 100.0
+    f = int(k)
+    if f + 1 >= len(ordered): return ordered[f]
+    return ordered[f] + (ordered[f+1] - ordered[f]) * (k - f)
+
+def columnStats(ts, values, percentiles=(5, 25, 50, 75, 95)):
+    """
+    Statistics of one column of values (NaN ignored) : count, min, max, mean, date_min, date_max
+    (timestamp of the first min and max) and percentiles { p : value }. Values are None for an empty column
+    """
+    if numpy is not None:
+        t = numpy.frombuffer(ts, dtype=numpy.int64)
+        v = numpy.frombuffer(values, dtype=numpy.float64)
+        valid = ~numpy.isnan(v)
+        count = int(valid.sum())
+        if count:
+            t, v = t[valid], v[valid]
+            iMin, iMax = int(v.argmin()), int(v.argmax())
+            pct = numpy.percentile(v, percentiles).tolist() if percentiles else []
+            return {"count" : count, "min" : float(v[iMin]), "max" : float(v[iMax]), "mean" : float(v.mean()),
+                    "date_min" : int(t[iMin]), "date_max" : int(t[iMax]), "percentiles" : dict(zip(percentiles, pct))}
+    else:
+        pairs = [(x, d) for d, x in zip(ts, values) if x == x]
+        count = len(pairs)
+        if count:
+            vMin, dMin = min(pairs, key=lambda p: p[0])
+            vMax, dMax = max(pairs, key=lambda p: p[0])
+            ordered = sorted(x for x, _ in pairs) if percentiles else []
+            return {"count" : count, "min" : vMin, "max" : vMax, "mean" : sum(x for x, _ in pairs) / count,
+                    "date_min" : dMin, "date_max" : dMax, "percentiles" : {p : _percentile(ordered, p) for p in percentiles}}
+    return {"count" : 0, "min" : None, "max" : None, "mean" : None, "date_min" : None, "date_max" : None,
+            "percentiles" : {p : None for p in percentiles}}
+
+def measureStats(rows, mtypes, percentiles=(5, 25, 50, 75, 95)):
+    """
+    Statistics of each type of getmeasure rows (or a response body), decoded in a single pass
+
+    Args:
+        rows : (timestamp, [values]) iterable (eg. WeatherStationData.iterMeasure) or getmeasure body
+        mtypes : list of the types of the values, in request order
+
+    Returns:
+        { type : columnStats }
+    """
+    if isinstance(mtypes, str): mtypes = mtypes.split(",")
+    ts, columns = measureColumns(rows, len(mtypes))
+    return {t : columnStats(ts, c, percentiles) for t, c in zip(mtypes, columns)}
+
+
+class MeasureSeries:
+    """
+    Compact getmeasure result : timestamps in an array('q') and the values of each type in an array('d')
+    (NaN for missing values). Arrays support the buffer protocol, toNumpy and toPandas export them without copy
+
+    Args:
+        mtypes : list of measure types, in request order
+    """
+    __slots__ = ("types", "timestamps", "columns")
+
+    def __init__(self, mtypes):
+        if isinstance(mtypes, str): mtypes = mtypes.split(",")
+        self.types = list(mtypes)
+        self.timestamps = array("q")
+        self.columns = [array("d") for _ in self.types]
+
+    @classmethod
+    def fromRows(cls, rows, mtypes):
+        """Build a series from (timestamp, [values]) rows or a getmeasure body"""
+        series = cls(mtypes)
+        series.timestamps, series.columns = measureColumns(rows, len(series.types))
+        return series
+
+    def append(self, ts, values):
+        self.timestamps.append(ts)
+        for i, c in enumerate(self.columns):
+            v = values[i] if i < len(values) else None
+            c.append(_NAN if v is None else v)
+
+    def extend(self, other):
+        """Append the rows of another series of the same types (eg. next page)"""
+        self.timestamps.extend(other.timestamps)
+        for c, o in zip(self.columns, other.columns): c.extend(o)
+
+    def _sort(self):
+        ts = self.timestamps
+        if all(ts[i] < ts[i+1] for i in range(len(ts) - 1)): return
+        order = sorted(range(len(ts)), key=ts.__getitem__)
+        self.timestamps = array("q", (ts[i] for i in order))
+        self.columns = [array("d", (c[i] for i in order)) for c in self.columns]
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __iter__(self):
+        # (timestamp, [values]) rows as measureRows, None for missing values
+        for i, ts in enumerate(self.timestamps):
+            yield ts, [None if c[i] != c[i] else c[i] for c in self.columns]
+
+    def __getitem__(self, mtype):
+        """Values of a type as a memoryview"""
+        return memoryview(self.columns[self.types.index(mtype)])
+
+    def toNumpy(self):
+        """(timestamps, { type : values }) numpy arrays sharing the series memory"""
+        if numpy is None: raise ImportError("numpy is required")
+        return (numpy.frombuffer(self.timestamps, dtype=numpy.int64),
+                {t : numpy.frombuffer(c, dtype=numpy.float64) for t, c in zip(self.types, self.columns)})
+
+    def toPandas(self):
+        """DataFrame of the types indexed by UTC datetimes, value columns sharing the series memory"""
+        import pandas
+        ts, values = self.toNumpy()
+        index = pandas.DatetimeIndex(ts * 1000000000, tz="UTC")                          # Only the index is converted (ns)
+        return pandas.DataFrame(values, index=index, copy=False)
+
+def measureSeriesHook(mtypes):
+    """
+    json object_pairs_hook decoding the { "timestamp" : [values] } getmeasure body directly into
+    a MeasureSeries of mtypes, without building the dictionary (other objects are decoded as usual).
+    Optimized bodies are expanded into a MeasureSeries once their blocks are decoded
+    """
+    if isinstance(mtypes, str): mtypes = mtypes.split(",")
+    def hook(pairs):
+        if not pairs or not pairs[0][0].isdigit():
+            obj = dict(pairs)
+            # Optimized body : list of {"beg_time", "step_time", "value"} blocks
+            body = obj.get("body")
+            if isinstance(body, list) and body and isinstance(body[0], dict) and "beg_time" in body[0]:
+                obj["body"] = MeasureSeries.fromRows(body, mtypes)
+            return obj
+        series = MeasureSeries(mtypes)
+        for ts, values in pairs: series.append(int(ts), values)
+        series._sort()
+        return series
+    return hook
+
+
+# Nominal length of rollup scales, buckets being aligned on the local time of the station
+_ROLLUP_SCALES = {"30min" : 1800, "1hour" : 3600, "3hours" : 3*3600, "1day" : 24*3600, "1week" : 7*24*3600, "1month" : 28*24*3600}
+# Suffix of aggregate getmeasure types (min_temp, date_max_hum, sum_rain...)
+_ROLLUP_SUFFIX = {"temp" : "Temperature", "hum" : "Humidity", "pressure" : "Pressure", "co2" : "CO2", "noise" : "Noise", "rain" : "Rain"}
+
+def bucketStart(ts, scale, tz=None):
+    """Start (epoch) of the scale bucket holding ts, in timezone tz (tzinfo, default : local time). Weeks start on Monday"""
+    dt = datetime.fromtimestamp(ts, tz) if tz else datetime.fromtimestamp(ts)
+    if scale == "30min":
+        dt = dt.replace(minute=dt.minute - dt.minute % 30, second=0, microsecond=0)
+    elif scale == "1hour":
+        dt = dt.replace(minute=0, second=0, microsecond=0)
+    elif scale == "3hours":
+        dt = dt.replace(hour=dt.hour - dt.hour % 3, minute=0, second=0, microsecond=0)
+    elif scale == "1day":
+        dt = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+    elif scale == "1week":
+        dt = dt.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=dt.weekday())
+    elif scale == "1month":
+        dt = dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    else:
+        raise ValueError("Unknown scale %s" % scale)
+    return int(dt.timestamp()) if tz else int(time.mktime(dt.timetuple()))
+
+def bucketBounds(ts, scale, tz=None):
+    """(start, end) of the scale bucket holding ts, end excluded. Days of DST changes last 23 or 25 hours"""
+    start = bucketStart(ts, scale, tz)
+    after = start + _ROLLUP_SCALES[scale]
+    while bucketStart(after, scale, tz) <= start: after += 3600
+    return start, bucketStart(after, scale, tz)
+
+
+class Rollup:
+    """
+    Local aggregation of "max" scale measures into the API aggregate scales, so that all zoom levels
+    are computed from a single series instead of one getmeasure request per scale. Samples can be added
+    incrementally (each sample once, in any order), buckets being aligned on the station local time
+
+    Args:
+        mtypes : list of measure types of the samples (eg. ["Temperature", "Humidity"])
+        scales : aggregate scales to maintain
+        timezone : station timezone name (station['place']['timezone']), default : local time
+    """
+    def __init__(self, mtypes, scales=("30min", "1hour", "3hours", "1day", "1week"), timezone=None):
+        if isinstance(mtypes, str): mtypes = mtypes.split(",")
+        self.types = list(mtypes)
+        self.scales = list(scales)
+        if timezone and ZoneInfo is None: logger.warning("zoneinfo unavailable, local time used for rollup buckets")
+        self.tz = ZoneInfo(timezone) if timezone and ZoneInfo else None
+        self._buckets = {scale : {} for scale in self.scales}                              # scale : { start : aggregates }
+        self._current = {scale : (0, 0) for scale in self.scales}                          # Bounds of the last bucket used
+
+    def add(self, ts, values):
+        """Add a sample (timestamp, [values in types order]), None values being ignored"""
+        for scale in self.scales:
+            start, end = self._current[scale]
+            if not start <= ts < end:
+                start, end = self._current[scale] = bucketBounds(ts, scale, self.tz)
+            bucket = self._buckets[scale].get(start)
+            if bucket is None:
+                # Per type : [min, max, sum, count, date_min, date_max]
+                bucket = self._buckets[scale][start] = [[None, None, 0, 0, None, None] for _ in self.types]
+            for agg, v in zip(bucket, values):
+                if v is None: continue
+                # Dates of the first min and max, whatever the order of the samples
+                if agg[0] is None or v < agg[0] or (v == agg[0] and ts < agg[4]): agg[0], agg[4] = v, ts
+                if agg[1] is None or v > agg[1] or (v == agg[1] and ts < agg[5]): agg[1], agg[5] = v, ts
+                agg[2] += v
+                agg[3] += 1
+
+    def extend(self, rows):
+        """Add (timestamp, [values]) rows, a getmeasure body or a MeasureSeries"""
+        if isinstance(rows, dict) or _isBlocks(rows): rows = measureRows(rows)
+        for ts, values in rows: self.add(ts, values)
+
+    def _value(self, agg, name):
+        if name in self.types:
+            # Plain type is the average, except rain which is summed
+            a = agg[self.types.index(name)]
+            return None if not a[3] else a[2] if name == "Rain" else a[2] / a[3]
+        for prefix, i in (("date_min_", 4), ("date_max_", 5), ("min_", 0), ("max_", 1), ("sum_", 2)):
+            if name.startswith(prefix):
+                suffix = name[len(prefix):]
+                mtype = _ROLLUP_SUFFIX.get(suffix, suffix)
+                if mtype not in self.types: break
+                a = agg[self.types.index(mtype)]
+                return a[i] if a[3] else None
+        raise ValueError("Type %s can't be computed from %s" % (name, ",".join(self.types)))
+
+    def rows(self, scale, mtypes=None, date_begin=None, date_end=None):
+        """
+        (bucket start, [values]) rows of a scale in time order, as getmeasure rows of that scale
+
+        Args:
+            mtypes : list of types as for getmeasure : a sampled type for its average (sum for Rain), or
+                     min_xxx, max_xxx, date_min_xxx, date_max_xxx, sum_xxx with xxx being temp, hum, pressure,
+                     co2, noise, rain or a sampled type (default : averages of all types)
+            date_begin, date_end : optional bounds of bucket starts
+        """
+        if isinstance(mtypes, str): mtypes = mtypes.split(",")
+        mtypes = mtypes or self.types
+        buckets = self._buckets[scale]
+        rows = []
+        for start in sorted(buckets):
+            if (date_begin and start < date_begin) or (date_end and start > date_end): continue
+            rows.append((start, [self._value(buckets[start], t) for t in mtypes]))
+        return rows
+
+
+class ExtremesTracker:
+    """
+    Running min and max of the stations and modules built only from the dashboard data of successive
+    WeatherStationData (no getmeasure request) : today's temperature extremes are those of the dashboard,
+    other measures (Humidity, CO2, Noise, Pressure...) and other windows use the samples seen by update
+
+    Args:
+        keep (int): age (seconds) of the oldest samples kept
+    """
+    def __init__(self, keep=7*24*3600):
+        self.keep = keep
+        self._samples = {}                                                                # id : deque of (time_utc, {type : value})
+        self._day = {}                                                                    # id : today's dashboard extremes
+        self._tz = {}                                                                     # id : station tzinfo
+        self._names = {}                                                                  # module name : id
+
+    def update(self, weatherData):
+        """Record the dashboard data of all stations and modules, return the number of new samples"""
+        count = 0
+        for s in weatherData.rawData:
+            timezone = s.get('place', {}).get('timezone')
+            tz = ZoneInfo(timezone) if timezone and ZoneInfo else None
+            for device in [s] + s.get('modules', []):
+                ds = device.get('dashboard_data')
+                if not ds or 'time_utc' not in ds: continue
+                mid = device['_id']
+                self._names[device.get('module_name', mid)] = mid
+                self._tz[mid] = tz
+                samples = self._samples.setdefault(mid, deque())
+                if samples and ds['time_utc'] <= samples[-1][0]: continue
+                samples.append((ds['time_utc'], {k : v for k, v in ds.items()
+                                                 if isinstance(v, (int, float)) and not k.startswith(("min_", "max_", "date_", "time_"))}))
+                while samples[0][0] < ds['time_utc'] - self.keep: samples.popleft()
+                self._day[mid] = {k : ds[k] for k in ("min_temp", "max_temp", "date_min_temp", "date_max_temp") if k in ds}
+                count += 1
+        return count
+
+    def _id(self, module):
+        return module if module in self._samples else self._names.get(module)
+
+    def extremes(self, module, mtype, date_begin=None, date_end=None):
+        """(min, date_min, max, date_max) of a type over the samples seen in the range, None if no sample"""
+        mid = self._id(module)
+        if mid is None: raise NoDevice("No sample of module %s" % module)
+        result = None
+        for ts, values in self._samples[mid]:
+            if (date_begin and ts < date_begin) or (date_end and ts > date_end) or mtype not in values: continue
+            v = values[mtype]
+            if result is None: result = [v, ts, v, ts]
+            elif v < result[0]: result[0:2] = v, ts
+            elif v > result[2]: result[2:4] = v, ts
+        return tuple(result) if result else None
+
+    def today(self, module=None):
+        """
+        Today's (station local day) { type : (min, date_min, max, date_max) } of a module,
+        or { module_name : {...} } of all modules if none is given
+        """
+        if module is None:
+            return {name : self.today(mid) for name, mid in self._names.items()}
+        mid = self._id(module)
+        if mid is None: raise NoDevice("No sample of module %s" % module)
+        samples = self._samples[mid]
+        start = bucketStart(samples[-1][0], "1day", self._tz[mid])
+        result = {}
+        for mtype in samples[-1][1]:
+            result[mtype] = self.extremes(mid, mtype, start)
+        day = self._day.get(mid, {})
+        if "min_temp" in day and "max_temp" in day and day.get("date_min_temp", 0) >= start:
+            result["Temperature"] = (day["min_temp"], day.get("date_min_temp"), day["max_temp"], day.get("date_max_temp"))
+        return result
+
+
+class Snapshot:
+    """
+    Last measure times of a station and its modules (as lastData) taken once, stored in an array so that
+    staleness, updated and not updated queries are a single comparison for any delay.
+    Devices and dashboard data are given as read-only views, not copies
+
+    Args:
+        station : station dictionary (WeatherStationData.getStation)
+    """
+    __slots__ = ("taken", "names", "_devices", "_index", "_times")
+
+    def __init__(self, station):
+        self.taken = time.time()
+        devices = [station] + [m for m in station.get('modules', []) if 'dashboard_data' in m]
+        devices = [d for d in devices if 'dashboard_data' in d]
+        self.names = tuple(d.get('module_name', d['_id']) for d in devices)
+        self._devices = devices
+        self._index = {n : i for i, n in enumerate(self.names)}
+        # Missing time_utc is considered as just updated (as lastData)
+        self._times = array("d", (d['dashboard_data'].get('time_utc', self.taken) for d in devices))
+
+    @property
+    def times(self):
+        """Read-only view of the last measure times, in names order"""
+        if numpy is not None:
+            t = numpy.frombuffer(self._times, dtype=numpy.float64)
+            t.flags.writeable = False
+            return t
+        view = memoryview(self._times)
+        return view.toreadonly() if hasattr(view, "toreadonly") else view
+
+    def _select(self, mask):
+        return [self.names[i] for i in numpy.flatnonzero(mask)] if numpy is not None else list(compress(self.names, mask))
+
+    def notUpdated(self, delay=3600, now=None):
+        """Names of devices whose last measure is older than delay seconds"""
+        limit = (now or time.time()) - delay
+        if numpy is not None: return self._select(self.times < limit)
+        return self._select([t < limit for t in self._times])
+
+    def updated(self, delay=3600, now=None):
+        """Names of devices whose last measure is newer than delay seconds"""
+        limit = (now or time.time()) - delay
+        if numpy is not None: return self._select(self.times > limit)
+        return self._select([t > limit for t in self._times])
+
+    def staleness(self, now=None):
+        """{ name : seconds since the last measure }"""
+        now = now or time.time()
+        return {n : now - t for n, t in zip(self.names, self._times)}
+
+    def device(self, name):
+        """Read-only view of a station or module dictionary"""
+        return MappingProxyType(self._devices[self._index[name]])
+
+    def data(self, name):
+        """Read-only view of the dashboard data of a station or module"""
+        return MappingProxyType(self._devices[self._index[name]]['dashboard_data'])
+
+    def __contains__(self, name):
+        return name in self._index
+
+    def __len__(self):
+        return len(self.names)
+
+
+class PollScheduler:
+    """
+    Poll getstationsdata shortly after the predicted uploads of the stations instead of at a fixed interval.
+    The upload period and phase of each station are learnt from its successive upload times (last_status_store,
+    else the newest time_utc), the station is expected again at last upload + period. When a fetch finds a
+    station not updated yet, it is asked again after a growing backoff. Stations expected within coalesce
+    seconds of each other share the same fetch (one getstationsdata returns all stations)
+
+    Args:
+        weatherData (WeatherStationData): object refreshed by poll (see WeatherStationData.refresh)
+        delay (int): seconds waited after the predicted upload
+        backoff, maxBackoff (int): first and max delays when the data is not fresh yet
+        coalesce (int): max seconds a fetch is postponed to serve several stations
+    """
+    def __init__(self, weatherData, delay=30, backoff=30, maxBackoff=300, coalesce=60):
+        self.weatherData = weatherData
+        self.delay = delay
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.coalesce = coalesce
+        self.fetches = 0
+        self._stations = {}                                                               # id : state
+        self.observe()
+
+    @staticmethod
+    def _uploadTime(station):
+        times = [m.get('dashboard_data', {}).get('time_utc', 0) for m in [station] + station.get('modules', [])]
+        return station.get('last_status_store') or max(times)
+
+    def observe(self, now=None):
+        """Learn from the current content of weatherData, return the ids of stations with a new upload"""
+        now = now or time.time()
+        fresh = []
+        for d in self.weatherData.rawData:
+            upload = self._uploadTime(d)
+            st = self._stations.get(d['_id'])
+            if st is None:
+                st = self._stations[d['_id']] = {"last" : upload, "period" : _UPLOAD_PERIOD, "deltas" : deque(maxlen=8), "retry" : 0}
+            elif upload > st["last"]:
+                # Missed uploads make the delta a multiple of the period
+                delta = upload - st["last"]
+                st["deltas"].append(delta / max(1, round(delta / float(st["period"]))))
+                st["period"] = sorted(st["deltas"])[len(st["deltas"]) // 2]
+                st["last"] = upload
+                st["retry"] = 0
+                fresh.append(d['_id'])
+            elif st.get("due") is not None and now >= st["due"]:
+                # Expected but not there yet
+                st["retry"] = min(st["retry"] * 2 or self.backoff, self.maxBackoff)
+                st["due"] = now + st["retry"]
+                continue
+            elif st["retry"]:
+                # Backing off, keep its due time
+                continue
+            st["due"] = self.nextUpload(d['_id'], now) + self.delay
+        return fresh
+
+    def nextUpload(self, station_id, now=None):
+        """Predicted time of the next upload of a station, now if it is overdue"""
+        now = now or time.time()
+        st = self._stations[station_id]
+        return max(now, st["last"] + st["period"])
+
+    def phase(self, station_id):
+        """(period, phase) learnt for a station, phase being the upload time modulo the period"""
+        st = self._stations[station_id]
+        return st["period"], st["last"] % st["period"]
+
+    def nextPoll(self):
+        """Time of the next fetch : the earliest due station, postponed to serve those due within coalesce seconds"""
+        due = sorted(st["due"] for st in self._stations.values())
+        group = [t for t in due if t <= due[0] + self.coalesce]
+        return group[-1]
+
+    def poll(self):
+        """Wait for the next fetch, refresh weatherData and return its change set"""
+        wait = self.nextPoll() - time.time()
+        if wait > 0: time.sleep(wait)
+        changes = self.weatherData.refresh()
+        self.fetches += 1
+        self.observe()
+        return changes
+
+    def run(self, callback, count=None):
+        """Call callback(changes) after each poll, forever or count times"""
+        while count is None or count > 0:
+            callback(self.poll())
+            if count is not None: count -= 1
+
+    def staleness(self, now=None):
+        """
+        { module_name : { "station_id", "time_utc", "age", "next_upload" } } of all stations and modules,
+        age being the seconds since the last measure and next_upload the predicted upload of its station
+        """
+        now = now or time.time()
+        result = {}
+        for d in self.weatherData.rawData:
+            nextUpload = self.nextUpload(d['_id'], now)
+            for m in [d] + d.get('modules', []):
+                t = m.get('dashboard_data', {}).get('time_utc')
+                result[m.get('module_name', m['_id'])] = {"station_id" : d['_id'], "time_utc" : t,
+                                                          "age" : now - t if t else None, "next_upload" : nextUpload}
+        return result
+
+
+class Backfill:
+    """
+    Download the history of all stations and modules of a WeatherStationData.
+    The range of each module is split into windows of about one getmeasure page, requested
+    in parallel by a bounded pool of threads (the postRequest rate limiter keeps the quota).
+    Completed windows are recorded in a checkpoint file per module so that an interrupted
+    backfill resumes where it left off
+
+    Args:
+        weatherData (WeatherStationData): Stations and modules to backfill
+        sink : function(device_id, module_id, types, rows) receiving the (timestamp, [values]) rows of each window.
+               Calls are serialized but windows are not delivered in time order
+        checkpointDir (str): Directory of checkpoint files, None for no checkpoint
+        date_begin : Start of the history (epoch), default to each module setup date
+        date_end : End of the history (epoch), default to now
+        scale (str): getmeasure scale
+        workers (int): Number of requests in parallel
+        reportEvery (int): Seconds between two progress logs
+    """
+    def __init__(self, weatherData, sink, checkpointDir=None, date_begin=None, date_end=None,
+                 scale="max", optimize=True, workers=4, reportEvery=30):
+        self.weatherData = weatherData
+        self.sink = sink
+        self.checkpointDir = expanduser(checkpointDir) if checkpointDir else None
+        self.date_begin = date_begin
+        self.date_end = int(date_end or time.time())
+        self.scale = scale
+        self.optimize = optimize
+        self.workers = workers
+        self.reportEvery = reportEvery
+        self.span = 1000 * _SCALE_STEP[scale]                                             # A bit less than a page of 1024 values
+        self._lock = threading.Lock()
+        self.rows = self.requests = self.windows = self.done = self.failed = 0
+        self._start = None
+
+    def _checkpointFile(self, device_id, module_id):
+        name = "%s_%s.json" % (device_id, module_id or "station")
+        return os.path.join(self.checkpointDir, name.replace(":", "-"))
+
+    def plan(self):
+        """Return the list of (device_id, module_id, types, checkpoint, windowBegin) still to download"""
+        tasks = []
+        for s in self.weatherData.rawData:
+            for m in [s] + s.get('modules', []):
+                module_id = None if m is s else m['_id']
+                types = measureTypes(m)
+                if not types: continue
+                begin = int(self.date_begin or m.get('date_setup') or s.get('date_setup', 0))
+                checkpoint = {"scale" : self.scale, "types" : types, "span" : self.span, "begin" : begin, "done" : []}
+                path = self._checkpointFile(s['_id'], module_id) if self.checkpointDir else None
+                if path and os.path.exists(path):
+                    with open(path, "r", encoding="utf-8") as f:
+                        previous = json.loads(f.read())
+                    # Keep the windows grid of the interrupted run
+                    if all(previous.get(k) == checkpoint[k] for k in ("scale", "types", "span")):
+                        checkpoint = previous
+                        if begin < checkpoint["begin"]:
+                            # Extend the grid backwards to the requested begin
+                            checkpoint["begin"] -= (checkpoint["begin"] - begin + self.span - 1) // self.span * self.span
+                            logger.warning("Backfill checkpoint of %s %s extended to %s" % (s['_id'], module_id, toTimeString(checkpoint["begin"])))
+                checkpoint["path"] = path
+                done = set(checkpoint["done"])
+                for wb in range(checkpoint["begin"], self.date_end, self.span):
+                    # Windows before the requested begin (saved by a previous run) are not downloaded
+                    if wb not in done and wb + self.span > begin: tasks.append((s['_id'], module_id, types, checkpoint, wb))
+        return tasks
+
+    def _window(self, device_id, module_id, types, checkpoint, wb):
+        we = min(wb + self.span, self.date_end + 1) - 1
+        try:
+            rows = list(self.weatherData.iterMeasure(device_id, module_id, types, wb, we, self.scale, self.optimize))
+        except Exception as e:
+            logger.error("Backfill of %s %s from %s failed : %s" % (device_id, module_id, toTimeString(wb), e))
+            with self._lock:
+                self.failed += 1
+            return
+        with self._lock:
+            if rows: self.sink(device_id, module_id, types, rows)
+            self.rows += len(rows)
+            self.requests += len(rows) // 1024 + 1                                        # iterMeasure stops on the first partial page
+            self.done += 1
+            # Only complete windows are recorded, the last one will be completed by next run
+            if checkpoint["path"] and wb + self.span <= self.date_end + 1:
+                checkpoint["done"].append(wb)
+                writeAtomic(checkpoint["path"], json.dumps({k:v for k,v in checkpoint.items() if k != "path"}))
+
+    def progress(self):
+        """Return a dictionary of backfill statistics"""
+        with self._lock:
+            elapsed = time.time() - self._start if self._start else 0
+            return {"windows" : self.windows, "done" : self.done, "failed" : self.failed,
+                    "rows" : self.rows, "requests" : self.requests, "elapsed" : elapsed,
+                    "rowsPerSecond" : self.rows / elapsed if elapsed else 0,
+                    "requestsPerHour" : self.requests * 3600 / elapsed if elapsed else 0}
+
+    def run(self):
+        """Run the backfill and return the final progress statistics"""
+        from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+        if self.checkpointDir and not os.path.isdir(self.checkpointDir): os.makedirs(self.checkpointDir)
+        tasks = self.plan()
+        self.windows = len(tasks)
+        self._start = lastReport = time.time()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            pending = set(executor.submit(self._window, *t) for t in tasks)
+            while pending:
+                finished, pending = wait(pending, timeout=self.reportEvery, return_when=FIRST_COMPLETED)
+                for f in finished: f.result()
+                if time.time() - lastReport >= self.reportEvery:
+                    lastReport = time.time()
+                    p = self.progress()
+                    logger.info("Backfill %d/%d windows, %d rows, %.1f rows/s, %.0f requests/h" % (
+                                 p["done"], p["windows"], p["rows"], p["rowsPerSecond"], p["requestsPerHour"]))
+        return self.progress()
+
+
+class MeasureStore:
+    """
+    Local append-only store of measures. Each type of each module is stored as two columns :
+    int64 timestamps (sorted, thus their own index for range lookups) and float64 values (NaN if missing),
+    files being memory mapped for zero copy reads. A single process should write in a store
+
+    Args:
+        path (str): Directory of the store, created if needed
+    """
+    def __init__(self, path):
+        self.path = expanduser(path)
+        self._lock = threading.Lock()
+        self._maps = {}                                                                   # file : (size, mmap)
+
+    def _files(self, device_id, module_id, mtype):
+        d = os.path.join(self.path, device_id.replace(":", "-"), (module_id or "station").replace(":", "-"))
+        return os.path.join(d, mtype + ".ts"), os.path.join(d, mtype + ".val")
+
+    def _map(self, path):
+        # Mapping is renewed when the file grew, previous ones stay valid for views already given
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        cached = self._maps.get(path)
+        if cached and cached[0] == size: return cached[1]
+        if not size: return None
+        with open(path, "rb") as f:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps[path] = (size, m)
+        return m
+
+    def _columns(self, device_id, module_id, mtype):
+        # Return (timestamps, values) memoryviews
+        tsFile, valFile = self._files(device_id, module_id, mtype)
+        with self._lock:
+            tsMap, valMap = self._map(tsFile), self._map(valFile)
+        if not (tsMap and valMap): return memoryview(b"").cast("q"), memoryview(b"").cast("d")
+        # An interrupted append may have left a column longer than the other
+        count = min(len(tsMap), len(valMap)) // 8
+        return memoryview(tsMap)[:count*8].cast("q"), memoryview(valMap)[:count*8].cast("d")
+
+    def last(self, device_id, module_id, mtype):
+        """Return the newest stored timestamp, None if nothing is stored"""
+        ts, _ = self._columns(device_id, module_id, mtype)
+        return ts[-1] if len(ts) else None
+
+    def count(self, device_id, module_id, mtype):
+        return len(self._columns(device_id, module_id, mtype)[0])
+
+    def append(self, device_id, module_id, mtype, rows):
+        """Append (timestamp, value) rows in time order, rows not newer than the last stored one are skipped"""
+        last = self.last(device_id, module_id, mtype)
+        ts, val = array("q"), array("d")
+        for t, v in rows:
+            if last is not None and t <= last: continue
+            ts.append(int(t))
+            val.append(float("nan") if v is None else v)
+            last = t
+        if not ts: return 0
+        tsFile, valFile = self._files(device_id, module_id, mtype)
+        with self._lock:
+            if not os.path.isdir(os.path.dirname(tsFile)): os.makedirs(os.path.dirname(tsFile))
+            # Drop what an interrupted append left (a longer column or a partial item) to keep columns aligned
+            sizes = [os.path.getsize(f) if os.path.exists(f) else 0 for f in (tsFile, valFile)]
+            size = min(sizes) // 8 * 8
+            for f, fsize in zip((tsFile, valFile), sizes):
+                if fsize != size:
+                    with open(f, "r+b") as fd: fd.truncate(size)
+            with open(valFile, "ab") as f: val.tofile(f)
+            with open(tsFile, "ab") as f: ts.tofile(f)
+        return len(ts)
+
+    def read(self, device_id, module_id, mtype, date_begin=None, date_end=None):
+        """
+        Return (timestamps, values) of the range [date_begin, date_end] without copying data :
+        numpy arrays if numpy is available else memoryviews (formats "q" and "d")
+        """
+        ts, val = self._columns(device_id, module_id, mtype)
+        start = bisect.bisect_left(ts, date_begin) if date_begin is not None else 0
+        stop = bisect.bisect_right(ts, date_end) if date_end is not None else len(ts)
+        ts, val = ts[start:stop], val[start:stop]
+        if numpy is not None:
+            return numpy.frombuffer(ts, dtype=numpy.int64), numpy.frombuffer(val, dtype=numpy.float64)
+        return ts, val
+
+    def sync(self, weatherData, date_begin=None, scale="max"):
+        """
+        Fetch and append measures newer than the last stored ones for all stations and modules
+        of weatherData (from date_begin or the module setup date for empty columns). Return the number of rows added
+        """
+        added = 0
+        for s in weatherData.rawData:
+            for m in [s] + s.get('modules', []):
+                module_id = None if m is s else m['_id']
+                types = measureTypes(m)
+                if not types: continue
+                lasts = [self.last(s['_id'], module_id, t) for t in types]
+                since = min(lasts) if None not in lasts else int(date_begin or m.get('date_setup') or s.get('date_setup', 0)) - 1
+                batch = []
+                for row in weatherData.iterMeasure(s['_id'], module_id, types, since + 1, scale=scale):
+                    batch.append(row)
+                    if len(batch) >= 1024:
+                        added += self._appendRows(s['_id'], module_id, types, batch)
+                        batch = []
+                added += self._appendRows(s['_id'], module_id, types, batch)
+        return added
+
+    def _appendRows(self, device_id, module_id, types, rows):
+        if not rows: return 0
+        for i, t in enumerate(types):
+            self.append(device_id, module_id, t, ((ts, values[i]) for ts, values in rows))
+        return len(rows)
+
+
+class IntervalSet:
+    """Sorted list of disjoint [begin, end] integer intervals"""
+    def __init__(self, intervals=()):
+        self.intervals = []
+        for b, e in intervals: self.add(b, e)
+
+    def add(self, begin, end):
+        if begin > end: return
+        # Merge with overlapping or adjacent intervals
+        i = bisect.bisect_left(self.intervals, [begin])
+        if i and self.intervals[i-1][1] >= begin - 1: i -= 1
+        j = i
+        while j < len(self.intervals) and self.intervals[j][0] <= end + 1:
+            begin, end = min(begin, self.intervals[j][0]), max(end, self.intervals[j][1])
+            j += 1
+        self.intervals[i:j] = [[begin, end]]
+
+    def missing(self, begin, end):
+        """Return the sub-ranges of [begin, end] not covered"""
+        gaps = []
+        for b, e in self.intervals:
+            if e < begin: continue
+            if b > end: break
+            if b > begin: gaps.append((begin, b - 1))
+            begin = e + 1
+        if begin <= end: gaps.append((begin, end))
+        return gaps
+
+    def __iter__(self):
+        return iter(self.intervals)
+
+
+class MeasureCache:
+    """
+    Persistent getmeasure cache (sqlite) keyed by (device_id, module_id, scale, type), recording the time
+    ranges already covered. A request is served from the cache and only the missing sub-ranges are requested.
+    Used by WeatherStationData.getMeasure (thus MinMaxTH and getStationMinMaxTH) when given as measureCache
+
+    Args:
+        path (str): sqlite database, ":memory:" for a cache limited to the process
+    """
+    def __init__(self, path="~/.netatmo.measures"):
+        self.path = expanduser(path)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS measures (key TEXT, ts INTEGER, value, PRIMARY KEY (key, ts))")
+            self._db.execute("CREATE TABLE IF NOT EXISTS coverage (key TEXT, begin INTEGER, end INTEGER)")
+        self.requests = 0
+
+    @staticmethod
+    def _key(device_id, module_id, scale, mtype):
+        return "|".join((device_id, module_id or "", scale, mtype))
+
+    def coverage(self, device_id, module_id, scale, mtype):
+        rows = self._db.execute("SELECT begin, end FROM coverage WHERE key=?", (self._key(device_id, module_id, scale, mtype),))
+        return IntervalSet(rows.fetchall())
+
+    def _store(self, keys, rows, begin, end):
+        with self._lock, self._db:
+            for i, key in enumerate(keys):
+                self._db.executemany("INSERT OR REPLACE INTO measures VALUES (?,?,?)", ((key, ts, v[i]) for ts, v in rows))
+                covered = IntervalSet(self._db.execute("SELECT begin, end FROM coverage WHERE key=?", (key,)).fetchall())
+                covered.add(begin, end)
+                self._db.execute("DELETE FROM coverage WHERE key=?", (key,))
+                self._db.executemany("INSERT INTO coverage VALUES (?,?,?)", ((key, b, e) for b, e in covered))
+
+    def getMeasure(self, weatherData, device_id, scale, mtype, module_id=None, date_begin=None, date_end=None):
+        """Same result as WeatherStationData.getMeasure (without limit and optimize), only missing ranges are requested"""
+        types = mtype.split(",")
+        keys = [self._key(device_id, module_id, scale, t) for t in types]
+        now = int(time.time())
+        begin, end = int(date_begin), int(min(date_end or now, now))
+        # Measures not older than this may still be uploaded or aggregated by Netatmo
+        settled = now - max(2 * _UPLOAD_PERIOD, 2 * _SCALE_STEP.get(scale, 0))
+        lastUpload = _lastUpload(weatherData, device_id, module_id)
+        gaps = IntervalSet()
+        with self._lock:
+            for key in keys:
+                covered = IntervalSet(self._db.execute("SELECT begin, end FROM coverage WHERE key=?", (key,)).fetchall())
+                for b, e in covered.missing(begin, end): gaps.add(b, e)
+        # Raw measures after the last upload can only exist once the next upload is due
+        uploadDue = not lastUpload or now >= lastUpload + _UPLOAD_PERIOD
+        for b, e in gaps:
+            if scale == "max" and not uploadDue: e = min(e, lastUpload)
+            if b > e: continue
+            rows = list(weatherData.iterMeasure(device_id, module_id, mtype, b, e, scale))
+            self.requests += len(rows) // 1024 + 1
+            if e < settled:
+                coveredEnd = e
+            elif scale == "max":
+                # Recent range: covered up to the last measure or the last upload
+                # (known when weatherData was loaded, newer measures are requested once an upload is due)
+                coveredEnd = rows[-1][0] if rows else b - 1
+                if lastUpload: coveredEnd = max(coveredEnd, min(e, lastUpload))
+            else:
+                # The last bucket is still aggregated, requested again next time
+                coveredEnd = min(rows[-1][0] - 1, settled) if rows else b - 1
+            self._store(keys, rows, b, coveredEnd)
+        body = {}
+        with self._lock:
+            for i, key in enumerate(keys):
+                for ts, v in self._db.execute("SELECT ts, value FROM measures WHERE key=? AND ts BETWEEN ? AND ? ORDER BY ts", (key, begin, end)):
+                    body.setdefault(str(ts), [None] * len(types))[i] = v
+        return {"body" : body, "status" : "ok"}
+
+    def clear(self):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM measures")
+            self._db.execute("DELETE FROM coverage")
+
+
+def _stationModule(station, module):
+    # Module of a station by id or name, None if not found
+    return next((m for m in station.get('modules', []) if module in (m['_id'], m.get('module_name'))), None)
+
+def _lastUpload(weatherData, device_id, module_id):
+    # time_utc of the last data sent by a station or module, None if unknown
+    s = weatherData.stationIds.get(device_id) if hasattr(weatherData, "stationIds") else None
+    if not s: return None
+    m = s if not module_id else next((m for m in s.get('modules', []) if m['_id'] == module_id), {})
+    return m.get('dashboard_data', {}).get('time_utc')
+
+
 class HomeData:
     """
     List the Netatmo home informations (Homes, cameras, events, persons)
@@ -725,6 +2268,12 @@ class HomeData:
                         c["home_id"] = curHome['id']
             for camera,e in self.events.items():
                 self.lastEvent[camera] = e[sorted(e)[-1]]
+            self._source = _indexSource(self)
+            entries = []
+            for curHome in self.rawData['homes']:
+                for d in curHome.get('cameras', []) + curHome.get('smokedetectors', []):
+                    entries.append((d, d.get('name'), curHome['id'], curHome['name']))
+            deviceIndex.update(self._source, entries)
             #self.default_home has no key homeId use homeName instead!
             if not self.cameras[self.default_home] : raise NoDevice("No camera available in default home")
             self.default_camera = list(self.cameras[self.default_home].values())[0]
@@ -741,30 +2290,37 @@ class HomeData:
             if value['name'] == home:
                 return self.homes[key]
 
+    def _cameraHome(self, device):
+        # Home name of a camera of this object (smoke detectors are indexed too), None if not a camera
+        meta = deviceIndex.meta(device['id'], self._source)
+        return meta["home_name"] if meta and device['id'] in self.cameras.get(meta["home_name"], {}) else None
+
     def cameraById(self, cid):
-        for cam in self.cameras.values():
-            if cid in cam:
-                return cam[cid]
-        return None
+        cam = deviceIndex.get(cid, self._source) if cid else None
+        return cam if cam and cam['id'] == cid and self._cameraHome(cam) else None
 
     def cameraByName(self, camera=None, home=None):
         if not camera and not home:
             return self.default_camera
-        elif home and camera:
-            if home not in self.cameras:
-                return None
-            for cam_id in self.cameras[home]:
-                if self.cameras[home][cam_id]['name'] == camera:
-                    return self.cameras[home][cam_id]
-        elif not home and camera:
-            for h, cam_ids in self.cameras.items():
-                for cam_id in cam_ids:
-                    if self.cameras[h][cam_id]['name'] == camera:
-                        return self.cameras[h][cam_id]
+        elif camera:
+            for cam in deviceIndex.byName(camera, self._source):
+                h = self._cameraHome(cam)
+                if h and (not home or h == home):
+                    return cam
         else:
             return list(self.cameras[self.default_home].values())[0]
         return None
 
+    def model(self, keepRaw=False):
+        """{ "cameras" : [Camera], "persons" : [Person], "events" : [Event] } of all homes, in time order for events"""
+        result = {"cameras" : [], "persons" : [], "events" : []}
+        for h in self.rawData['homes']:
+            result["cameras"].extend(Camera(c, h['name'], keepRaw) for c in h.get('cameras', []))
+            result["persons"].extend(Person(p, keepRaw) for p in h.get('persons', []))
+            result["events"].extend(Event(e, keepRaw) for e in h.get('events', []))
+        result["events"].sort(key=lambda e: e.time or 0)
+        return result
+
     def cameraUrls(self, camera=None, home=None, cid=None):
         """
         Return the vpn_url and the local_url (if available) of a given camera
@@ -809,19 +2365,21 @@ class HomeData:
                     atHome.append(p['pseudo'])
         return atHome
 
-    def getCameraPicture(self, image_id, key):
+    def getCameraPicture(self, image_id, key, sink=None):
         """
         Download a specific image (of an event or user face) from the camera
+        If sink (eg. a file open in binary mode) is given, the image is written to it
+        and the number of bytes written is returned instead of the image
         """
         postParams = {
             "access_token" : self.getAuthToken,
             "image_id" : image_id,
             "key" : key
             }
-        resp = postRequest("Camera", _GETCAMERAPICTURE_REQ, postParams)
+        resp = postRequest("Camera", _GETCAMERAPICTURE_REQ, postParams, sink=sink)
         return resp, "jpeg"
 
-    def getProfileImage(self, name):
+    def getProfileImage(self, name, sink=None):
         """
         Retrieve the face of a given person
         """
@@ -830,7 +2388,7 @@ class HomeData:
                 if name == p['pseudo']:
                     image_id = p['face']['id']
                     key = p['face']['key']
-                    return self.getCameraPicture(image_id, key)
+                    return self.getCameraPicture(image_id, key, sink)
         return None, None
 
     def updateEvent(self, event=None, home=None):
@@ -959,11 +2517,11 @@ class HomeData:
         # resp = postRequest("Camera", _POST_UPDATE_HOME_REQ, postParams)
         # self.rawData = resp['body']
 
-    def getLiveSnapshot(self, camera=None, home=None, cid=None):
+    def getLiveSnapshot(self, camera=None, home=None, cid=None, sink=None):
         camera = self.cameraByName(home=home, camera=camera) or self.cameraById(cid=cid)
         vpnUrl, localUrl = self.cameraUrls(cid=camera["id"])
         url = localUrl or vpnUrl
-        return cameraCommand(url, _PRES_CDE_GET_SNAP)
+        return cameraCommand(url, _PRES_CDE_GET_SNAP, sink=sink)
 
 
 class WelcomeData(HomeData):
@@ -993,6 +2551,9 @@ class HomesData:
                 }
         #
         resp = postRequest("Module", _GETHOMES_DATA, postParams)
+        self._load(resp, home)
+
+    def _load(self, resp, home):
 #        self.rawData = resp['body']['devices']
         self.rawData = resp['body']['homes']
         if not self.rawData : raise NoHome("No home %s found" % home)
@@ -1030,15 +2591,19 @@ class HomeCoach:
                 "access_token" : self.getAuthToken
                 }
         resp = postRequest("HomeCoach", _GETHOMECOACH, postParams)
+        self._load(resp)
+
+    def _load(self, resp):
         self.rawData = resp['body']['devices']
         # homecoach data
         if not self.rawData : raise NoDevice("No HomeCoach available")
+        self._source = _indexSource(self)
+        deviceIndex.update(self._source, ((d, d.get('station_name') or d.get('module_name'), d.get('home_id'), d.get('home_name'))
+                                          for d in self.rawData))
 
     def HomecoachDevice(self, hid=""):
-        for device in self.rawData:
-           if hid == device['_id']:
-                return device
-           return None
+        device = deviceIndex.get(hid, self._source) if hid else None
+        return device if device and device['_id'] == hid else None
 
     def Dashboard(self, hid=""):
         #D = self.HomecoachDevice['dashboard_data']
@@ -1079,6 +2644,36 @@ def rawAPI(authData, url, parameters=None):
     resp = postRequest("rawAPI", fullUrl, parameters)
     return resp["body"] if "body" in resp else resp
 
+def measureParams(accessToken, device_id, scale, mtype, module_id=None, date_begin=None, date_end=None, limit=None, optimize=False, real_time=False):
+    postParams = { "access_token" : accessToken }
+    postParams['device_id']  = device_id
+    if module_id : postParams['module_id'] = module_id
+    postParams['scale']      = scale
+    postParams['type']       = mtype
+    if date_begin : postParams['date_begin'] = date_begin
+    if date_end : postParams['date_end'] = date_end
+    if limit : postParams['limit'] = limit
+    postParams['optimize'] = "true" if optimize else "false"
+    postParams['real_time'] = "true" if real_time else "false"
+    return postParams
+
+def measureRows(body):
+    """
+    Generator of (timestamp, [values]) rows of a getmeasure response body in time order.
+    Both formats are handled : { "timestamp" : [values] } and optimized ones [ {"beg_time", "step_time", "value"} ]
+    """
+    if not body: return
+    if isinstance(body, MeasureSeries):
+        for row in body: yield row
+    elif isinstance(body, dict):
+        for ts in sorted(body, key=int):
+            yield int(ts), body[ts]
+    else:
+        for block in body:
+            beg, step = block['beg_time'], block.get('step_time', 0)
+            for i, values in enumerate(block['value']):
+                yield beg + i * step, values
+
 def filter_home_data(rawData, home):
     if home:
         # Find a home who's home id or name is the one requested
@@ -1089,33 +2684,678 @@ def filter_home_data(rawData, home):
     # By default, the first home is returned
     return rawData[0]
 
-def cameraCommand(cameraUrl, commande, parameters=None, timeout=3):
+def cameraCommand(cameraUrl, commande, parameters=None, timeout=3, sink=None):
     url = cameraUrl + ( commande % parameters if parameters else commande)
-    return postRequest("Camera", url, timeout=timeout)
+    return postRequest("Camera", url, timeout=timeout, sink=sink)
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP(S) connections shared by all requests, one small pool per host.
+    Avoid a TCP connect and TLS handshake for each call to Netatmo servers.
+    Proxies are taken from the environment as urlopen does (HTTPS_PROXY, HTTP_PROXY, NO_PROXY...)
 
-def processErrorResp(resp):
+    Args:
+        maxSize (int): Maximum number of idle connections kept for each host
+        idleTimeout (int): Idle connections older than this number of seconds are closed
+    """
+    def __init__(self, maxSize=4, idleTimeout=60):
+        self.maxSize = maxSize
+        self.idleTimeout = idleTimeout
+        self._idle = {}                                                                   # (scheme, host, port, proxy) : [(lastUse, connection), ...]
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        # Called with lock held, drop connections not used for too long
+        for key in list(self._idle):
+            conns = self._idle[key]
+            while conns and now - conns[0][0] > self.idleTimeout:
+                conns.pop(0)[1].close()
+            if not conns: del self._idle[key]
+
+    def _get(self, key, timeout):
+        with self._lock:
+            self._expire(time.time())
+            conns = self._idle.get(key)
+            if conns:
+                conn = conns.pop()[1]
+                conn.timeout = timeout
+                if conn.sock: conn.sock.settimeout(timeout)
+                return conn, True
+        scheme, host, port, proxy = key
+        if not proxy:
+            connClass = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+            return connClass(host, port, timeout=timeout), False
+        p = urllib.parse.urlsplit(proxy)
+        proxyPort = p.port or (443 if p.scheme == "https" else 80)
+        if scheme == "https":
+            # TLS tunnel through the proxy (CONNECT)
+            conn = http.client.HTTPSConnection(p.hostname, proxyPort, timeout=timeout)
+            conn.set_tunnel(host, port, self._proxyHeaders(p))
+        else:
+            conn = http.client.HTTPConnection(p.hostname, proxyPort, timeout=timeout)
+        return conn, False
+
+    @staticmethod
+    def _proxyHeaders(p):
+        if p.username is None: return {}
+        credentials = "%s:%s" % (urllib.parse.unquote(p.username), urllib.parse.unquote(p.password or ""))
+        return {"Proxy-Authorization" : "Basic " + base64.b64encode(credentials.encode("utf-8")).decode("ascii")}
+
+    @staticmethod
+    def _proxy(u):
+        # Proxy URL for a target from the environment, None if not proxied
+        proxy = urllib.request.getproxies().get(u.scheme)
+        if not proxy or urllib.request.proxy_bypass(u.hostname): return None
+        return proxy if "://" in proxy else "http://" + proxy
+
+    def _put(self, key, conn):
+        with self._lock:
+            conns = self._idle.setdefault(key, [])
+            if len(conns) < self.maxSize:
+                conns.append((time.time(), conn))
+                return
+        conn.close()
+
+    def request(self, method, url, body=None, headers=None, timeout=10):
+        """
+        Send a request and return a context manager giving the http.client.HTTPResponse.
+        The connection is given back to the pool when the response has been fully read
+        """
+        u = urllib.parse.urlsplit(url)
+        proxy = self._proxy(u)
+        key = (u.scheme, u.hostname, u.port or (443 if u.scheme == "https" else 80), proxy)
+        path = u.path or "/"
+        if u.query: path += "?" + u.query
+        if proxy and u.scheme == "http":
+            # Plain http goes through the proxy with the absolute url
+            path = url
+            headers = dict(headers or {}, **self._proxyHeaders(urllib.parse.urlsplit(proxy)))
+        conn, reused = self._get(key, timeout)
+        try:
+            resp = self._send(conn, method, path, body, headers)
+        except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+            conn.close()
+            if not reused: raise
+            # The server closed the idle connection in between, retry once on a new one
+            conn, reused = self._get(key, timeout)
+            try:
+                resp = self._send(conn, method, path, body, headers)
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+        return _PooledResponse(self, key, conn, resp)
+
+    def _send(self, conn, method, path, body, headers):
+        if conn.sock is None:
+            # Connect explicitly to tell apart requests that never reached the server
+            try:
+                conn.connect()
+            except (OSError, http.client.HTTPException) as e:
+                raise ConnectError("Can't connect to %s : %s" % (conn.host, e))
+        conn.request(method, path, body, headers or {})
+        return conn.getresponse()
+
+    def clear(self):
+        """Close all idle connections"""
+        with self._lock:
+            for conns in self._idle.values():
+                for _, conn in conns: conn.close()
+            self._idle = {}
+
+
+class _PooledResponse:
+    """Give back the connection to its pool once the response is consumed"""
+    def __init__(self, pool, key, conn, resp):
+        self._pool, self._key, self._conn, self.resp = pool, key, conn, resp
+
+    def __enter__(self):
+        return self.resp
+
+    def __exit__(self, *exc):
+        if exc[0] is None and self.resp.isclosed() and not self.resp.will_close:
+            self._pool._put(self._key, self._conn)
+        else:
+            self._conn.close()
+        return False
+
+
+# Default pool used by postRequest (thus by all classes of this module)
+connectionPool = ConnectionPool() if PYTHON3 else None
+
+# Netatmo per user and application limits : 50 requests every 10 seconds and 500 requests every hour
+NETATMO_LIMITS = ((50, 10), (500, 3600))
+
+class RateLimiter:
+    """
+    Sliding window limiter consulted by postRequest before each Netatmo API request.
+    Requests are counted per application (client_id) and user. It is thread safe and,
+    if a stateFile is given, the quota is shared by all processes of the host using the same file
+
+    Args:
+        limits : Sequence of (maxRequests, periodSeconds) to respect
+        stateFile (str): Optional file where request times are recorded under a file lock
+        maxWait (float): Maximum time to wait for quota availability, RateLimited is raised if longer (None: wait as long as needed)
+    """
+    def __init__(self, limits=NETATMO_LIMITS, stateFile=None, maxWait=None):
+        self.limits = tuple(limits)
+        self.stateFile = expanduser(stateFile) if stateFile else None
+        self.maxWait = maxWait
+        self._lock = threading.Lock()
+        self._history = {}                                                                # key : [timestamps], used without stateFile
+        self._horizon = max(period for _, period in self.limits)
+
+    def _delay(self, history, now):
+        # Time to wait before history allows one more request
+        wait = 0
+        for maxRequests, period in self.limits:
+            window = [t for t in history if t > now - period]
+            if len(window) >= maxRequests:
+                wait = max(wait, window[len(window) - maxRequests] + period - now)
+        return wait
+
+    def _reserve(self, history, now):
+        history[:] = [t for t in history if t > now - self._horizon]
+        wait = self._delay(history, now)
+        if wait <= 0: history.append(now)
+        return wait
+
+    def reserve(self, key):
+        """
+        Record a request for key if the quota allows it and return 0,
+        else return the number of seconds to wait before trying again
+        """
+        now = time.time()
+        with self._lock:
+            if not self.stateFile:
+                return self._reserve(self._history.setdefault(key, []), now)
+            with open(self.stateFile, "a+", encoding="utf-8") as f:
+                if fcntl: fcntl.flock(f, fcntl.LOCK_EX)
+                f.seek(0)
+                content = f.read()
+                state = json.loads(content) if content else {}
+                wait = self._reserve(state.setdefault(key, []), now)
+                state = {k:v for k,v in state.items() if v}
+                f.seek(0)
+                f.truncate()
+                f.write(json.dumps(state))
+                f.flush()
+                return wait
+
+    def acquire(self, key):
+        """Wait until the quota allows a request for key and record it"""
+        waited = 0
+        while True:
+            wait = self.reserve(key)
+            if wait <= 0: return waited
+            if self.maxWait is not None and waited + wait > self.maxWait:
+                raise RateLimited("Netatmo quota exhausted for %s, retry in %.1f s" % (key, wait))
+            logger.debug("Rate limit reached for %s, waiting %.1f s" % (key, wait))
+            time.sleep(wait)
+            waited += wait
+
+
+# Default limiter used by postRequest (None to disable)
+rateLimiter = RateLimiter()
+
+# Application owning each access token, to count requests by application and user
+_tokenOwners = {}
+
+def registerToken(accessToken, clientId):
+    if len(_tokenOwners) > 1000: _tokenOwners.clear()
+    _tokenOwners[accessToken] = clientId
+
+def rateKey(accessToken):
+    # Netatmo access tokens are formatted as <user id>|<secret>
+    return "%s|%s" % (_tokenOwners.get(accessToken, ""), accessToken.split("|")[0])
+
+class RetryPolicy:
+    """
+    Retry of failed Netatmo API requests by postRequest : exponential backoff with jitter,
+    Retry-After header honored, all attempts bounded by a total deadline.
+    Only idempotent (read) requests are retried on errors and retryable HTTP status.
+    Token renewals are only retried when the request could not reach Netatmo as
+    the refresh token may already have been consumed by the server otherwise
+
+    Args:
+        retries (int): Maximum number of retries after the first attempt
+        backoff (float): Base delay in seconds, doubled after each attempt
+        maxBackoff (float): Maximum delay between two attempts
+        deadline (float): Maximum total time in seconds spent for the request
+        statuses : HTTP status codes worth a retry
+    """
+    def __init__(self, retries=3, backoff=0.5, maxBackoff=30, deadline=60, statuses=(429, 500, 502, 503, 504)):
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBackoff = maxBackoff
+        self.deadline = deadline
+        self.statuses = frozenset(statuses)
+
+    def delay(self, attempt, retryAfter=None):
+        # Full jitter : uniform between 0 and the exponential backoff
+        d = random.uniform(0, min(self.maxBackoff, self.backoff * 2 ** attempt))
+        retryAfter = parseRetryAfter(retryAfter)
+        return max(d, retryAfter) if retryAfter is not None else d
+
+    def next(self, attempt, start, retryAfter=None):
+        """Return the delay before the next attempt or None if the request should not be retried"""
+        if attempt >= self.retries: return None
+        d = self.delay(attempt, retryAfter)
+        if time.time() - start + d > self.deadline: return None
+        return d
+
+
+# Default retry policy used by postRequest (None to disable)
+retryPolicy = RetryPolicy()
+
+# Netatmo API requests without side effects
+_READ_REQUESTS = frozenset((_GETMEASURE_REQ, _GETSTATIONDATA_REQ, _GETTHERMOSTATDATA_REQ, _GETHOMEDATA_REQ,
+                            _GETCAMERAPICTURE_REQ, _GETEVENTSUNTIL_REQ, _HOME_STATUS, _GETHOMES_DATA, _GETHOMECOACH))
+
+def isIdempotent(url):
+    if url in _READ_REQUESTS: return True
+    # rawAPI calls : reads are get* services, homesdata and homestatus
+    service = url.rsplit("/", 1)[-1]
+    return url.startswith(_BASE_URL + "api/") and (service.startswith("get") or service in ("homesdata", "homestatus"))
+
+def parseRetryAfter(value):
+    # Retry-After is either a number of seconds or an HTTP date
+    if not value: return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        from email.utils import parsedate_tz, mktime_tz
+        return max(0, mktime_tz(parsedate_tz(value)) - time.time())
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+def processErrorResp(body):
     try:
-        error_detail = json.loads(resp.fp.read().decode("utf-8"))["error"]
+        error_detail = json.loads(body.decode("utf-8"))["error"]
         logger.error("Netatmo response error 403 : %s" % repr(error_detail))
     except Exception as e:
         logger.error("Error getting body of 403 HTTP error from Netatmo : %s" % e)
 
-def postRequest(topic, url, params=None, timeout=10):
+def decodeResponse(status, reason, contentType, data, hook=None):
+    if status >= 400:
+        if status == 403:
+            processErrorResp(data)
+        else:
+            logger.error("code=%s, reason=%s, body=%s" % (status, reason, data))
+        return None
+    # Return values in bytes if not json data to handle properly camera images
+    return json.loads(data, object_pairs_hook=hook) if "application/json" in (contentType or "") else data
+
+class TransferStats:
+    """
+    Count bytes received by postRequest : wireBytes as transferred (possibly compressed)
+    and bodyBytes once decompressed. Totals are kept globally and by topic,
+    last is the (topic, wireBytes, bodyBytes) of the last request made by the current thread
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.wireBytes = 0
+            self.bodyBytes = 0
+            self.byTopic = {}                                                             # topic : [requests, wireBytes, bodyBytes]
+
+    def record(self, topic, wireBytes, bodyBytes):
+        self._local.last = (topic, wireBytes, bodyBytes)
+        with self._lock:
+            self.requests += 1
+            self.wireBytes += wireBytes
+            self.bodyBytes += bodyBytes
+            t = self.byTopic.setdefault(topic, [0, 0, 0])
+            t[0] += 1
+            t[1] += wireBytes
+            t[2] += bodyBytes
+
+    @property
+    def last(self):
+        return getattr(self._local, "last", None)
+
+    @property
+    def saved(self):
+        return self.bodyBytes - self.wireBytes
+
+
+# Byte counters updated by postRequest
+transferStats = TransferStats()
+
+def _decompressor(encoding):
+    # Return a zlib decompressor for a Content-Encoding value, None if no (supported) compression
+    encoding = (encoding or "").strip().lower()
+    if encoding in ("gzip", "x-gzip"): return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if encoding == "deflate": return _DeflateDecompressor()
+    return None
+
+class _DeflateDecompressor:
+    """Some servers send raw deflate streams instead of zlib ones, detect it on first chunk"""
+    def __init__(self):
+        self._d = zlib.decompressobj()
+        self._first = True
+
+    def decompress(self, data):
+        if self._first:
+            self._first = False
+            try:
+                return self._d.decompress(data)
+            except zlib.error:
+                self._d = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._d.decompress(data)
+
+    def flush(self):
+        return self._d.flush()
+
+def decompress(data, encoding):
+    d = _decompressor(encoding)
+    return d.decompress(data) + d.flush() if d else data
+
+def readBody(resp, sink=None, chunkSize=65536, encoding=None, topic=None):
+    """
+    Read a response body in linear time (chunks are joined once at the end)
+    or stream it to sink (any object with a write method) and return the number of bytes written.
+    A gzip or deflate encoded body is decompressed on the fly
+    """
+    chunks = []
+    write = sink.write if sink else chunks.append
+    d = _decompressor(encoding)
+    wireSize = size = 0
+    for buff in iter(lambda: resp.read(chunkSize), b''):
+        wireSize += len(buff)
+        if d: buff = d.decompress(buff)
+        if buff:
+            write(buff)
+            size += len(buff)
+    if d:
+        buff = d.flush()
+        if buff:
+            write(buff)
+            size += len(buff)
+    transferStats.record(topic, wireSize, size)
+    return size if sink else b"".join(chunks)
+
+class _SinkGuard:
+    # Count the bytes written to a caller sink, rewind it before a retry when it is seekable
+    def __init__(self, sink):
+        self.sink, self.written, self.start = sink, 0, None
+        try:
+            if all(hasattr(sink, a) for a in ("seek", "tell", "truncate")) and getattr(sink, "seekable", lambda: True)():
+                self.start = sink.tell()
+        except (OSError, ValueError):
+            pass
+
+    def write(self, data):
+        self.written += len(data)
+        return self.sink.write(data)
+
+    def rewind(self):
+        """Return True if the request can be sent again (nothing written or sink rewound)"""
+        if not self.written: return True
+        if self.start is None: return False
+        self.sink.seek(self.start)
+        self.sink.truncate()
+        self.written = 0
+        return True
+
+class MemoryCache:
+    """
+    In memory LRU backend for ResponseCache
+
+    Args:
+        maxEntries (int): Maximum number of responses kept
+    """
+    def __init__(self, maxEntries=256):
+        self.maxEntries = maxEntries
+        self._entries = OrderedDict()                                                     # key : (expires, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if not entry: return None
+            if entry[0] < time.time():
+                del self._entries[key]
+                return None
+            self._entries[key] = self._entries.pop(key)                                   # Most recently used
+            return entry[1]
+
+    def set(self, key, value, expires):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (expires, value)
+            while len(self._entries) > self.maxEntries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SqliteCache:
+    """
+    On disk backend for ResponseCache, the database can be shared by several processes
+
+    Args:
+        path (str): sqlite database file
+    """
+    def __init__(self, path="~/.netatmo.cache"):
+        self.path = expanduser(path)
+        self._local = threading.local()                                                   # sqlite connections can't be shared between threads
+        self._puts = 0
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = sqlite3.connect(self.path, timeout=10)
+            db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, expires REAL, value BLOB)")
+        return db
+
+    def get(self, key):
+        row = self._db().execute("SELECT value FROM responses WHERE key=? AND expires>=?", (key, time.time())).fetchone()
+        return bytes(row[0]) if row else None
+
+    def set(self, key, value, expires):
+        db = self._db()
+        with db:
+            db.execute("INSERT OR REPLACE INTO responses VALUES (?,?,?)", (key, expires, sqlite3.Binary(value)))
+            self._puts += 1
+            if not self._puts % 100: db.execute("DELETE FROM responses WHERE expires<?", (time.time(),))
+
+    def clear(self):
+        db = self._db()
+        with db:
+            db.execute("DELETE FROM responses")
+
+
+def _stationsTTL(resp, params):
+    # Stations upload every 10 minutes, keep the response until the next expected upload of any station
+    now = time.time()
+    nextUpload = []
+    for d in resp.get('body', {}).get('devices', []):
+        times = [m['dashboard_data']['time_utc'] for m in [d] + d.get('modules', []) if 'time_utc' in m.get('dashboard_data', {})]
+        if times: nextUpload.append(max(times) + _UPLOAD_PERIOD)
+    return min(max(min(nextUpload) - now, 30), _UPLOAD_PERIOD) if nextUpload else 30
+
+def _measureTTL(resp, params):
+    # Past measures do not change anymore
+    end = params.get('date_end')
+    return 24*3600 if end and float(end) < time.time() - 3600 else 300
+
+# Average time between two uploads of a station to Netatmo servers
+_UPLOAD_PERIOD = 600
+
+# Default time to live of read responses, in seconds or function(response, params), not listed services are never cached
+CACHE_TTL = {
+    _GETSTATIONDATA_REQ    : _stationsTTL,
+    _GETHOMECOACH          : _stationsTTL,
+    _GETMEASURE_REQ        : _measureTTL,
+    _GETHOMES_DATA         : 6*3600,                                                      # Topology rarely changes
+    _GETTHERMOSTATDATA_REQ : 60,
+    _GETHOMEDATA_REQ       : 60,
+    _HOME_STATUS           : 30,
+    }
+
+class ResponseCache:
+    """
+    Cache of Netatmo read responses used by postRequest, keyed by service, parameters and user.
+    Commands are never cached
+
+    Args:
+        backend : MemoryCache (default) or SqliteCache instance
+        ttl (dict): service url : time to live in seconds or function(response, params), default CACHE_TTL
+    """
+    def __init__(self, backend=None, ttl=None):
+        self.backend = backend or MemoryCache()
+        self.ttl = CACHE_TTL if ttl is None else ttl
+        self.hits = self.misses = 0
+
+    def key(self, url, params):
+        """Return the cache key of a request, None if it must not be cached"""
+        if url not in self.ttl or "access_token" not in params: return None
+        request = {k:str(v) for k,v in params.items() if k != "access_token"}
+        request[" user"] = rateKey(params["access_token"])
+        return hashlib.sha1((url + json.dumps(request, sort_keys=True)).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        # Responses are stored serialized, each caller get its own copy to modify
+        return json.loads(value)
+
+    def put(self, key, url, params, resp):
+        if not isinstance(resp, dict) or resp.get("status", "ok") != "ok": return
+        ttl = self.ttl[url]
+        if callable(ttl): ttl = ttl(resp, params)
+        if ttl > 0: self.backend.set(key, json.dumps(resp).encode("utf-8"), time.time() + ttl)
+
+    def clear(self):
+        self.backend.clear()
+
+
+# Response cache used by postRequest, disabled by default (eg. lnetatmo.responseCache = lnetatmo.ResponseCache())
+responseCache = None
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent identical requests : the first caller sends the request, callers
+    arriving while it is in flight wait for it and get the same result (a copy) or exception
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}                                                                  # key : [event, result, exception, waiters]
+
+    def do(self, key, function):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader: call = self._calls[key] = [threading.Event(), None, None, 0]
+            else: call[3] += 1
+        if not leader:
+            call[0].wait()
+            if call[2] is not None: raise call[2]
+            return copy.deepcopy(call[1])
+        result = None
+        try:
+            result = function()
+            return result
+        except Exception as e:
+            call[2] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                waiters = call[3]
+            # Waiters copy a snapshot taken before the leader caller gets (and may change) the result
+            if waiters and call[2] is None: call[1] = copy.deepcopy(result)
+            call[0].set()
+
+    @staticmethod
+    def key(url, params):
+        return url + "?" + json.dumps({k:str(v) for k,v in params.items()}, sort_keys=True)
+
+
+# Coalescing of concurrent identical read requests by postRequest (None to disable)
+singleFlight = SingleFlight()
+
+def postRequest(topic, url, params=None, timeout=10, sink=None, hook=None):
+    """
+    Send a request to Netatmo (or camera) and return decoded json, or raw bytes for other contents.
+    If a sink (object with a write method, eg. an open file) is given, non json contents (eg. camera images)
+    are streamed to it and the number of bytes written is returned instead.
+    A hook is given to the json decoder as object_pairs_hook (such results are neither cached nor shared)
+    """
+    if hook: return _sendRequest(topic, url, params, timeout, sink, hook)
+    cache = responseCache if params and not sink else None
+    key = cache.key(url, params) if cache else None
+    if key:
+        resp = cache.get(key)
+        if resp is not None: return resp
+    def send():
+        resp = _sendRequest(topic, url, params, timeout, sink)
+        if key: cache.put(key, url, params, resp)
+        return resp
+    if singleFlight and params and not sink and isIdempotent(url):
+        return singleFlight.do(SingleFlight.key(url, params), send)
+    return send()
+
+def _sendRequest(topic, url, params, timeout, sink, hook=None):
     if PYTHON3:
-        req = urllib.request.Request(url)
+        headers = {"Accept-Encoding" : "gzip, deflate"}
+        token = None
         if params:
-            req.add_header("Content-Type","application/x-www-form-urlencoded;charset=utf-8")
+            headers["Content-Type"] = "application/x-www-form-urlencoded;charset=utf-8"
             if "access_token" in params:
-                req.add_header("Authorization","Bearer %s" % params.pop("access_token"))
+                token = params.pop("access_token")
+                headers["Authorization"] = "Bearer %s" % token
             params = urllib.parse.urlencode(params).encode('utf-8')
-        try:
-            resp = urllib.request.urlopen(req, params, timeout=timeout) if params else urllib.request.urlopen(req, timeout=timeout)
-        except urllib.error.HTTPError as err:
-            if err.code == 403:
-                processErrorResp(err)
-            else:
-                logger.error("code=%s, reason=%s, body=%s" % (err.code, err.reason, err.fp.read()))
-            return None
+        policy = retryPolicy if url.startswith(_BASE_URL) else None
+        idempotent = isIdempotent(url)
+        start, attempt = time.time(), 0
+        guard = _SinkGuard(sink) if sink else None
+        while True:
+            if token and rateLimiter and url.startswith(_BASE_URL): rateLimiter.acquire(rateKey(token))
+            retryAfter = None
+            try:
+                with connectionPool.request("POST" if params else "GET", url, params, headers, timeout) as resp:
+                    contentType = resp.getheader("Content-Type")
+                    encoding = resp.getheader("Content-Encoding")
+                    if sink and resp.status < 400 and "application/json" not in (contentType or ""):
+                        return readBody(resp, guard, encoding=encoding, topic=topic)
+                    data = readBody(resp, encoding=encoding, topic=topic)
+                    status, reason = resp.status, resp.reason
+                    retryAfter = resp.getheader("Retry-After")
+                if not (policy and idempotent and status in policy.statuses):
+                    return decodeResponse(status, reason, contentType, data, hook)
+                failure = "code=%s" % status
+                delay = policy.next(attempt, start, retryAfter)
+                if delay is None: return decodeResponse(status, reason, contentType, data, hook)
+            except ConnectError as e:
+                # Request not sent, safe to retry whatever the request is
+                delay = policy.next(attempt, start) if policy else None
+                if delay is None: raise
+                failure = e
+            except (OSError, http.client.HTTPException) as e:
+                delay = policy.next(attempt, start) if policy and idempotent else None
+                # A partially written sink can't be retried unless it can be rewound
+                if delay is None or (guard and not guard.rewind()): raise
+                failure = e
+            logger.warning("%s request failed (%s), retry in %.1f s" % (topic, failure, delay))
+            time.sleep(delay)
+            attempt += 1
     else:
         if params:
             token = params.pop("access_token") if "access_token" in params else None
@@ -1128,11 +3368,10 @@ def postRequest(topic, url, params=None, timeout=10):
         except urllib2.HTTPError as err:
             logger.error("code=%s, reason=%s" % (err.code, err.reason))
             return None
-    data = b""
-    for buff in iter(lambda: resp.read(65535), b''): data += buff
-    # Return values in bytes if not json data to handle properly camera images
-    returnedContentType = resp.getheader("Content-Type") if PYTHON3 else resp.info()["Content-Type"]
-    return json.loads(data.decode("utf-8")) if "application/json" in returnedContentType else data
+        contentType = resp.info()["Content-Type"]
+        if sink and "application/json" not in contentType:
+            return readBody(resp, sink, topic=topic)
+        return decodeResponse(200, None, contentType, readBody(resp, topic=topic), hook)
 
 def toTimeString(value):
     return time.strftime("%Y-%m-%d_%H:%M:%S", time.localtime(int(value)))
@@ -1147,30 +3386,59 @@ def todayStamps():
 
 # Global shortcut
 
-def getStationMinMaxTH(station=None, module=None, home=None):
-    authorization = ClientAuth()
-    devList = WeatherStationData(authorization, station=station, home=home)
+def getStationMinMaxTH(station=None, module=None, home=None, measureCache=None, weatherData=None, frame="last24", workers=4):
+    """
+    Current temperature and humidity of a module with their min and max over the frame ("last24" or "day").
+    With module="*", { module_name : (minT, T, maxT) } of all modules updated during the last hour, the
+    getmeasure requests being issued concurrently by up to workers threads (within the rate limiter quota).
+    A WeatherStationData can be given to reuse its session instead of authenticating and fetching again
+    (station and home then select one of its stations, measureCache must be the one it was created with)
+    """
+    if weatherData:
+        if measureCache is not None and measureCache is not getattr(weatherData, "measureCache", None):
+            raise ValueError("measureCache must be given to the WeatherStationData")
+        if home and not station:
+            if home not in weatherData.homes : raise NoHome("No home with name %s" % home)
+            station = weatherData.homes[home]
+        devList = weatherData
+    else:
+        devList = WeatherStationData(ClientAuth(), station=station, home=home, measureCache=measureCache)
+    s = devList.getStation(station)
+    if not s : raise NoDevice("No station with name or id %s" % station)
+    station = s['_id']
     if module == "*":
         pass
     elif module:
-        module = devList.moduleById(module) or devList.moduleByName(module)
-        if not module: raise NoDevice("No such module %s" % module)
-        module = module["module_name"]
+        m = _stationModule(s, module) or (s if module in (s['_id'], s.get('module_name')) else None)
+        if not m: raise NoDevice("No such module %s" % module)
+        module = m["module_name"]
     else:
-        module = list(devList.modules.values())[0]["module_name"]
-    lastD = devList.lastData()
+        module = s['modules'][0]["module_name"]
+    lastD = devList.lastData(station)
     if module == "*":
         result = {}
+        pending = []
         for m,v in lastD.items():
             if time.time()-v['When'] > 3600 : continue
-            r = devList.MinMaxTH(module=m)
+            # Today's extremes are already in the dashboard
+            if frame == "day" and 'min_temp' in v and 'max_temp' in v and v['When'] >= todayStamps()[0]:
+                result[m] = (v['min_temp'], v['Temperature'], v['max_temp'])
+            else:
+                pending.append(m)
+        if len(pending) > 1 and workers > 1:
+            from concurrent.futures import ThreadPoolExecutor
+            with ThreadPoolExecutor(max_workers=min(workers, len(pending))) as executor:
+                stats = list(executor.map(lambda m: devList.MinMaxTH(module=m, frame=frame, station=station), pending))
+        else:
+            stats = [devList.MinMaxTH(module=m, frame=frame, station=station) for m in pending]
+        for m, r in zip(pending, stats):
             if r:
-                result[m] = (r[0], v['Temperature'], r[1])
+                result[m] = (r[0], lastD[m]['Temperature'], r[1])
     else:
         if time.time()-lastD[module]['When'] > 3600 : result = ["-", "-"]
         else :
             result = [lastD[module]['Temperature'], lastD[module]['Humidity']]
-            result.extend(devList.MinMaxTH(module))
+            result.extend(devList.MinMaxTH(module, frame=frame, station=station))
     return result
 
 
@@ -0,0 +1,355 @@
+# Multiple contributors : see https://github.com/philippelt/netatmo-api-python
+# License : GPL V3
+"""
+Asyncio flavour of the lnetatmo API : same data classes, but the network I/O is done
+by coroutines so that many accounts or homes can be polled from a single event loop.
+Requires Python 3.7+ and do not require anything else than standard libraries
+
+Usage :
+    auth = lnetatmo_async.ClientAuth()
+    weatherData = await lnetatmo_async.weatherStationData(auth)
+"""
+
+import asyncio
+import copy
+import ssl
+import threading
+import time
+import urllib.parse
+
+import lnetatmo
+from lnetatmo import logger
+
+
+class StreamBackend:
+    """
+    Minimal HTTP/1.1 client built on asyncio streams. Keep-alive connections are reused per host.
+    Any object providing the same request coroutine can be used as a backend (eg. a wrapper around aiohttp)
+
+    Args:
+        maxConnections (int): Maximum number of simultaneous requests in flight (all hosts)
+        maxIdle (int): Maximum number of idle connections kept for each host
+        idleTimeout (int): Idle connections not used for this number of seconds are closed
+    """
+    def __init__(self, maxConnections=20, maxIdle=4, idleTimeout=60):
+        self.maxConnections = maxConnections
+        self.maxIdle = maxIdle
+        self.idleTimeout = idleTimeout
+        self._loop = None
+        self._sslContext = None
+
+    def _bind(self):
+        # asyncio objects belong to a loop, rebuild them if the backend is reused on a new loop
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            self._loop = loop
+            self._semaphore = asyncio.Semaphore(self.maxConnections)
+            self._idle = {}                                                               # (scheme, host, port) : [(lastUse, reader, writer), ...]
+
+    async def _connect(self, key):
+        now = time.time()
+        conns = self._idle.get(key, [])
+        while conns:
+            lastUse, reader, writer = conns.pop()
+            if now - lastUse < self.idleTimeout and not reader.at_eof():
+                return reader, writer, True
+            writer.close()
+        scheme, host, port = key
+        if scheme == "https" and not self._sslContext:
+            self._sslContext = ssl.create_default_context()
+        try:
+            reader, writer = await asyncio.open_connection(host, port, ssl=self._sslContext if scheme == "https" else None)
+        except OSError as e:
+            raise lnetatmo.ConnectError("Can't connect to %s : %s" % (host, e))
+        return reader, writer, False
+
+    def _release(self, key, reader, writer):
+        conns = self._idle.setdefault(key, [])
+        if len(conns) < self.maxIdle:
+            conns.append((time.time(), reader, writer))
+        else:
+            writer.close()
+
+    async def request(self, method, url, body=None, headers=None, timeout=10):
+        """
+        Send a request and return a tuple (status, reason, headers, data)
+        headers is a dictionary with lower case keys, data are the raw bytes of the body
+        """
+        self._bind()
+        u = urllib.parse.urlsplit(url)
+        key = (u.scheme, u.hostname, u.port or (443 if u.scheme == "https" else 80))
+        path = u.path or "/"
+        if u.query: path += "?" + u.query
+        lines = ["%s %s HTTP/1.1" % (method, path), "Host: %s" % u.netloc, "Content-Length: %d" % len(body or b"")]
+        lines.extend("%s: %s" % kv for kv in (headers or {}).items())
+        message = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + (body or b"")
+        async with self._semaphore:
+            return await asyncio.wait_for(self._exchange(key, method, message), timeout)
+
+    async def _exchange(self, key, method, message):
+        reader, writer, reused = await self._connect(key)
+        try:
+            writer.write(message)
+            await writer.drain()
+            resp = await self._readResponse(reader, method)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            writer.close()
+            if not reused: raise
+            # The server closed the idle connection in between, retry once on a new one
+            reader, writer, reused = await self._connect(key)
+            try:
+                writer.write(message)
+                await writer.drain()
+                resp = await self._readResponse(reader, method)
+            except BaseException:
+                writer.close()
+                raise
+        except BaseException:
+            writer.close()
+            raise
+        status, reason, headers, data, keepAlive = resp
+        if keepAlive:
+            self._release(key, reader, writer)
+        else:
+            writer.close()
+        return status, reason, headers, data
+
+    async def _readResponse(self, reader, method):
+        statusLine = await reader.readline()
+        if not statusLine: raise ConnectionResetError("Connection closed by server")
+        version, status, reason = (statusLine.decode("latin-1").rstrip("\r\n").split(" ", 2) + [""])[:3]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""): break
+            k, _, v = line.decode("latin-1").partition(":")
+            headers[k.strip().lower()] = v.strip()
+        keepAlive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        if method == "HEAD" or status in ("204", "304"):
+            data = b""
+        elif headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if not size: break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            # Skip trailers
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""): pass
+            data = b"".join(chunks)
+        elif "content-length" in headers:
+            data = await reader.readexactly(int(headers["content-length"]))
+        else:
+            data = await reader.read()
+            keepAlive = False
+        return int(status), reason, headers, data, keepAlive
+
+
+# Default backend used by postRequest
+defaultBackend = StreamBackend()
+
+
+async def acquireQuota(limiter, key):
+    """Non blocking equivalent of RateLimiter.acquire"""
+    waited = 0
+    while True:
+        wait = limiter.reserve(key)
+        if wait <= 0: return waited
+        if limiter.maxWait is not None and waited + wait > limiter.maxWait:
+            raise lnetatmo.RateLimited("Netatmo quota exhausted for %s, retry in %.1f s" % (key, wait))
+        await asyncio.sleep(wait)
+        waited += wait
+
+
+async def postRequest(topic, url, params=None, timeout=10, backend=None):
+    """
+    Coroutine equivalent of lnetatmo.postRequest, backend default to the module defaultBackend
+    """
+    cache = lnetatmo.responseCache if params else None
+    key = cache.key(url, params) if cache else None
+    if key:
+        resp = cache.get(key)
+        if resp is not None: return resp
+    if not (lnetatmo.singleFlight and params and lnetatmo.isIdempotent(url)):
+        return await _send(topic, url, params, timeout, backend, cache, key)
+    # Coalesce concurrent identical requests of the running loop
+    flightKey = (asyncio.get_running_loop(), lnetatmo.SingleFlight.key(url, params))
+    flight = _inFlight.get(flightKey)
+    if flight:
+        flight[1] += 1
+        return copy.deepcopy(await asyncio.shield(flight[0]))
+    flight = _inFlight[flightKey] = [asyncio.ensure_future(_send(topic, url, params, timeout, backend, cache, key)), 0]
+    flight[0].add_done_callback(lambda f: _inFlight.pop(flightKey, None))
+    resp = await asyncio.shield(flight[0])
+    # With waiters, the shared result is left untouched and each caller gets its own copy
+    return copy.deepcopy(resp) if flight[1] else resp
+
+# Requests in flight : (loop, request key) : [future, waiters]
+_inFlight = {}
+
+async def _send(topic, url, params, timeout, backend, cache, key):
+    resp = await _sendRequest(topic, url, params, timeout, backend)
+    if key: cache.put(key, url, params, resp)
+    return resp
+
+async def _sendRequest(topic, url, params, timeout, backend):
+    headers = {"Accept-Encoding" : "gzip, deflate"}
+    token = None
+    if params:
+        headers["Content-Type"] = "application/x-www-form-urlencoded;charset=utf-8"
+        if "access_token" in params:
+            token = params.pop("access_token")
+            headers["Authorization"] = "Bearer %s" % token
+        params = urllib.parse.urlencode(params).encode('utf-8')
+    policy = lnetatmo.retryPolicy if url.startswith(lnetatmo._BASE_URL) else None
+    idempotent = lnetatmo.isIdempotent(url)
+    start, attempt = time.time(), 0
+    while True:
+        if token and lnetatmo.rateLimiter and url.startswith(lnetatmo._BASE_URL):
+            await acquireQuota(lnetatmo.rateLimiter, lnetatmo.rateKey(token))
+        try:
+            status, reason, respHeaders, data = await (backend or defaultBackend).request(
+                    "POST" if params else "GET", url, params, headers, timeout)
+            wireSize = len(data)
+            data = lnetatmo.decompress(data, respHeaders.get("content-encoding"))
+            lnetatmo.transferStats.record(topic, wireSize, len(data))
+            if not (policy and idempotent and status in policy.statuses):
+                return lnetatmo.decodeResponse(status, reason, respHeaders.get("content-type"), data)
+            failure = "code=%s" % status
+            delay = policy.next(attempt, start, respHeaders.get("retry-after"))
+            if delay is None: return lnetatmo.decodeResponse(status, reason, respHeaders.get("content-type"), data)
+        except lnetatmo.ConnectError as e:
+            # Request not sent, safe to retry whatever the request is
+            delay = policy.next(attempt, start) if policy else None
+            if delay is None: raise
+            failure = e
+        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            delay = policy.next(attempt, start) if policy and idempotent else None
+            if delay is None: raise
+            failure = e
+        lnetatmo.logger.warning("%s request failed (%s), retry in %.1f s" % (topic, failure, delay))
+        await asyncio.sleep(delay)
+        attempt += 1
+
+
+class ClientAuth(lnetatmo.ClientAuth):
+    """
+    Same as lnetatmo.ClientAuth with a coroutine to get the access token,
+    concurrent coroutines wait for a single token renewal
+
+    Args:
+        see lnetatmo.ClientAuth
+        backend : Optional backend used for token renewal
+    """
+    def __init__(self, clientId=None,
+                       clientSecret=None,
+                       refreshToken=None,
+                       credentialFile=None,
+                       tokenStore=None,
+                       account="default",
+                       backend=None):
+        super().__init__(clientId, clientSecret, refreshToken, credentialFile, tokenStore, account)
+        self.backend = backend
+        self._renewing = None
+
+    async def getAccessToken(self):
+        if self.expiration < time.time():
+            if not self._renewing:
+                self._renewing = asyncio.ensure_future(self.renewTokenAsync())
+                self._renewing.add_done_callback(lambda f: setattr(self, "_renewing", None))
+            await asyncio.shield(self._renewing)
+        return self._accessToken
+
+    async def renewTokenAsync(self):
+        # Same locks as the synchronous renewal (thread lock and credential file lock) held for the whole
+        # reload, renew, save sequence. They are taken and released by a helper thread as the thread lock
+        # must be released by its owner and flock would block the event loop
+        loop = asyncio.get_event_loop()
+        acquired, release = loop.create_future(), threading.Event()
+        def notify(error=None):
+            if acquired.done(): return
+            if error: acquired.set_exception(error)
+            else: acquired.set_result(None)
+        def hold():
+            try:
+                with self._lock, lnetatmo.fileLock(self._renewLockFile()):
+                    loop.call_soon_threadsafe(notify)
+                    release.wait()
+            except Exception as e:
+                loop.call_soon_threadsafe(notify, e)
+        holder = threading.Thread(target=hold, name="lnetatmo-renew-lock")
+        holder.daemon = True
+        holder.start()
+        try:
+            await acquired
+            # Another process may have renewed the tokens, never use a stale refresh token
+            expiration = self.expiration
+            self._reloadStored()
+            if self.expiration > expiration: return
+            resp = await postRequest("authentication", lnetatmo._AUTH_REQ, self._renewParams(), backend=self.backend)
+            if not resp and self._reloadStored():
+                resp = await postRequest("authentication", lnetatmo._AUTH_REQ, self._renewParams(), backend=self.backend)
+            if not resp: raise lnetatmo.AuthFailure("Token renewal rejected by Netatmo")
+            self._tokenReceived(resp)
+        finally:
+            release.set()
+
+
+# Async factories returning regular lnetatmo objects (already loaded)
+
+async def weatherStationData(authData, home=None, station=None, backend=None):
+    ws = lnetatmo.WeatherStationData.__new__(lnetatmo.WeatherStationData)
+    ws.getAuthToken = await authData.getAccessToken()
+    postParams = { "access_token" : ws.getAuthToken }
+    resp = await postRequest("Weather station", lnetatmo._GETSTATIONDATA_REQ, postParams, backend=backend)
+    ws._load(resp, home, station)
+    return ws
+
+async def homeStatus(authData, home_id, backend=None):
+    hs = lnetatmo.HomeStatus.__new__(lnetatmo.HomeStatus)
+    hs.getAuthToken = await authData.getAccessToken()
+    postParams = { "access_token" : hs.getAuthToken, "home_id" : home_id }
+    resp = await postRequest("home_status", lnetatmo._HOME_STATUS, postParams, backend=backend)
+    hs._load(resp, home_id)
+    return hs
+
+async def homesData(authData, home=None, backend=None):
+    hd = lnetatmo.HomesData.__new__(lnetatmo.HomesData)
+    hd.getAuthToken = await authData.getAccessToken()
+    postParams = { "access_token" : hd.getAuthToken, "home_id" : home }
+    resp = await postRequest("Module", lnetatmo._GETHOMES_DATA, postParams, backend=backend)
+    hd._load(resp, home)
+    return hd
+
+async def homeCoach(authData, backend=None):
+    hc = lnetatmo.HomeCoach.__new__(lnetatmo.HomeCoach)
+    hc.getAuthToken = await authData.getAccessToken()
+    postParams = { "access_token" : hc.getAuthToken }
+    resp = await postRequest("HomeCoach", lnetatmo._GETHOMECOACH, postParams, backend=backend)
+    hc._load(resp)
+    return hc
+
+async def getMeasure(authData, device_id, scale, mtype, module_id=None, date_begin=None, date_end=None, limit=None, optimize=False, real_time=False, backend=None):
+    postParams = lnetatmo.measureParams(await authData.getAccessToken(), device_id, scale, mtype, module_id, date_begin, date_end, limit, optimize, real_time)
+    return await postRequest("Weather station", lnetatmo._GETMEASURE_REQ, postParams, backend=backend)
+
+async def rawAPI(authData, url, parameters=None, backend=None):
+    fullUrl = lnetatmo._BASE_URL + "api/" + url
+    if parameters is None: parameters = {}
+    parameters["access_token"] = await authData.getAccessToken()
+    resp = await postRequest("rawAPI", fullUrl, parameters, backend=backend)
+    return resp["body"] if "body" in resp else resp
+
+
+if __name__ == "__main__":
+
+    import logging
+    logging.basicConfig(format='%(name)s - %(levelname)s: %(message)s', level=logging.INFO)
+
+    async def main():
+        authorization = ClientAuth()
+        weatherStation = await weatherStationData(authorization)
+        logger.info("Station %s" % weatherStation.default_station)
+
+    asyncio.run(main())
+    logger.info("OK")
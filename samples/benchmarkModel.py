@@ -0,0 +1,29 @@
+#!/usr/bin/python3
+
+# Library 4.2.1
+
+# Memory used by COPIES copies of the account weather stations : raw dictionaries
+# (as kept by WeatherStationData) against the compact Station/Module objects.
+# Both sides are built from a freshly decoded payload, so that no object is shared with weatherData
+
+import json, sys, tracemalloc
+import lnetatmo
+
+COPIES = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+authorization = lnetatmo.ClientAuth()
+weatherData = lnetatmo.WeatherStationData(authorization)
+payload = json.dumps(weatherData.rawData)
+
+def measure(build):
+    tracemalloc.start()
+    objects = [build() for _ in range(COPIES)]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return size
+
+rawSize = measure(lambda: json.loads(payload))
+modelSize = measure(lambda: [lnetatmo.Station(d) for d in json.loads(payload)])
+print(f"{COPIES} copies of {len(weatherData.rawData)} station(s)")
+print(f"raw dictionaries    : {rawSize/1024:10.0f} KiB")
+print(f"model               : {modelSize/1024:10.0f} KiB ({modelSize/rawSize:.0%})")
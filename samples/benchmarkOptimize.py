@@ -0,0 +1,37 @@
+#!/usr/bin/python3
+
+# Library 4.2.1
+
+# Compare getmeasure regular and optimized (optimize=True) formats on the last days of the
+# station own sensors : bytes transferred (wire and decompressed) and decode time
+
+import json, sys, time
+import lnetatmo
+
+DAYS = int(sys.argv[1]) if len(sys.argv) > 1 else 7
+
+authorization = lnetatmo.ClientAuth()
+weatherData = lnetatmo.WeatherStationData(authorization)
+station = weatherData.default_station_data
+types = lnetatmo.measureTypes(station)
+end = int(time.time())
+
+for optimize in (False, True):
+    lnetatmo.transferStats.reset()
+    pages, begin = [], end - DAYS * 24 * 3600
+    while True:
+        resp = weatherData.getMeasure(station['_id'], "max", ",".join(types), None, begin, end, 1024, optimize)
+        pages.append(json.dumps(resp))
+        ts, columns = lnetatmo.measureColumns(resp['body'], len(types))
+        if len(ts) < 1024: break
+        begin = ts[-1] + 1
+    # Decode again the received json to time json parsing and expansion into columns
+    start = time.perf_counter()
+    rows = 0
+    for page in pages:
+        ts, columns = lnetatmo.measureColumns(json.loads(page)['body'], len(types))
+        rows += len(ts)
+    elapsed = time.perf_counter() - start
+    stats = lnetatmo.transferStats
+    print(f"optimize={optimize!s:5} : {stats.requests} requests, {rows} rows, "
+          f"{stats.wireBytes} bytes received, {stats.bodyBytes} bytes decompressed, decode {elapsed*1000:.1f} ms")
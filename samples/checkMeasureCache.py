@@ -0,0 +1,20 @@
+#!/usr/bin/python3
+
+# Library 4.2.1
+
+# Check that the measure cache serves repeated dashboard queries : the second MinMaxTH of the
+# station must not send any getmeasure request (until the next upload of the station is due)
+
+import sys
+import lnetatmo
+
+authorization = lnetatmo.ClientAuth()
+cache = lnetatmo.MeasureCache(":memory:")
+weatherData = lnetatmo.WeatherStationData(authorization, measureCache=cache)
+
+first = weatherData.MinMaxTH()
+requests = cache.requests
+second = weatherData.MinMaxTH()
+print(f"first MinMaxTH : {requests} requests, second : {cache.requests - requests} requests")
+if first != second or cache.requests != requests:
+    sys.exit("second MinMaxTH was not served by the cache")
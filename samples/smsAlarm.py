@@ -17,19 +17,19 @@ MARKER_FILE = "/<somewhere>/TempAlarm"   # This flag file will be used to avoid
 # Access the station
 authorization = lnetatmo.ClientAuth()
 devList = lnetatmo.WeatherStationData(authorization)
+snapshot = devList.snapshot()            # Taken once, read-only views of the station and modules data
 
 message = []
 
 # Condition 1 : the external temperature is below our limit
-curT = devList.lastData()['external']['Temperature']
+curT = snapshot.data('external')['Temperature']
 if curT < 5 : message.append("Temperature going below 5°C")
 
 # Condition 2 : The external temperature data is older that 1 hour
-someLost = devList.checkNotUpdated()
-if someLost and 'external' in someLost : message.append("Sensor is no longer active")
+if 'external' in snapshot.notUpdated(3600) : message.append("Sensor is no longer active")
 
 # Condition 3 : The outdoor module battery is dying
-volts = devList.lastData()['external']['battery_vp'] # I suspect that this is the total Voltage in mV
+volts = snapshot.device('external')['battery_vp'] # I suspect that this is the total Voltage in mV
 if volts < 5000 : message.append("External module battery needs replacement") # I will adjust the threshold over time
 
 # If one condition is present, at least, send an alarm by SMS
@@ -13,7 +13,7 @@ setup(
         ],
     author='Philippe Larduinat',
     author_email='ph.larduinat@wanadoo.fr',
-    py_modules=['lnetatmo'],
+    py_modules=['lnetatmo', 'lnetatmo_async'],
     scripts=[],
     data_files=[],
     url='https://github.com/philippelt/netatmo-api-python',